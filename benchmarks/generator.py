@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic slave log output in the format written by the patched Postgres
+recovery (see postgres-9.3.3.patch and WAL_DEBUG).
+"""
+
+import random
+
+
+class LogGenerator(object):
+    # Filenodes of pg_namespace, pg_class and pg_attribute in a new database
+    catalog_nodes = {'pg_namespace': 2615, 'pg_class': 1259, 'pg_attribute': 1249}
+
+    def __init__(self, db_node=16384, spc_node=1663, rel_nodes=(16385,), seed=0):
+        self.db_node = db_node
+        self.spc_node = spc_node
+        self.rel_nodes = rel_nodes
+        self.random = random.Random(seed)
+        self.lsn = 0x1000000
+        self.xid = 1000
+
+    def redo(self, work):
+        prev = self.lsn
+        self.lsn += 0x40
+        return 'LOG:  REDO @ 0/{:X}; LSN 0/{:X}: prev 0/{:X}; xid {}; len 42: {}\n'.format(
+                prev, self.lsn, prev - 0x40, self.xid, work)
+
+    def rel(self, db_node=None, rel_node=None):
+        return 'rel {}/{}/{}'.format(self.spc_node, db_node or self.db_node,
+                rel_node or self.random.choice(self.rel_nodes))
+
+    def tid(self):
+        return '{}/{}'.format(self.random.randint(0, 10000), self.random.randint(1, 200))
+
+    def insert(self, **kwargs):
+        return self.redo('Heap - insert: {}; tid {}'.format(self.rel(**kwargs), self.tid()))
+
+    def update(self, hot=False, **kwargs):
+        return self.redo('Heap - {}update: {}; tid {} xmax {} ; new tid {} xmax 0'.format(
+            'hot_' if hot else '', self.rel(**kwargs), self.tid(), self.xid, self.tid()))
+
+    def delete(self, **kwargs):
+        return self.redo('Heap - delete: {}; tid {}'.format(self.rel(**kwargs), self.tid()))
+
+    def catalog(self, catalog=None):
+        """
+        A random insert, update or delete of a catalog tuple
+        """
+        catalog = catalog or self.random.choice(sorted(self.catalog_nodes))
+        rel_node = self.catalog_nodes[catalog]
+        return self.random.choice((self.insert, self.update, self.delete))(rel_node=rel_node)
+
+    def commit(self):
+        self.xid += 1
+        return self.redo('Transaction - commit: 2014-03-01 10:00:00.{:06d}'.format(self.xid % 1000000))
+
+    def other(self):
+        return self.redo('Standby - running xacts: nextXid {} latestCompletedXid {} oldestRunningXid {}'.format(
+            self.xid, self.xid - 1, self.xid))
+
+    def lines(self, count, mix=None, size=10, foreign=0.0):
+        """
+        Yields count lines of transactions with size records each. mix is a
+        dict of record kind (insert, update, hot_update, delete, catalog or
+        other) to weight, foreign is the share of heap records belonging to
+        another database.
+        """
+        mix = mix or {'insert': 4, 'update': 2, 'hot_update': 2, 'delete': 1, 'other': 1}
+        kinds = [kind for kind, weight in sorted(mix.items()) for i in range(weight)]
+        n = 0
+        while n < count:
+            for i in range(size):
+                kind = self.random.choice(kinds)
+                kwargs = {}
+                if kind not in ('other', 'catalog') and self.random.random() < foreign:
+                    kwargs['db_node'] = self.db_node + 1
+                if kind == 'insert':
+                    yield self.insert(**kwargs)
+                elif kind == 'update':
+                    yield self.update(**kwargs)
+                elif kind == 'hot_update':
+                    yield self.update(hot=True, **kwargs)
+                elif kind == 'delete':
+                    yield self.delete(**kwargs)
+                elif kind == 'catalog':
+                    yield self.catalog()
+                else:
+                    yield self.other()
+            yield self.commit()
+            yield 'LOG:  recovery has paused\n'
+            n += size + 2
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the LogParser with the RegExer it replaced on synthetic log lines.
+
+    python -m benchmarks.parser --lines 200000
+"""
+
+import argparse
+import timeit
+
+from history import RegExer, LogParser
+from benchmarks.generator import LogGenerator
+
+
+def regexer_run(regexer, lines, db_oid):
+    """
+    The line handling of Worker.consume and Worker.work with RegExer
+    """
+    records = 0
+    for line in lines:
+        if regexer.match('lastup', line):
+            pass
+        elif regexer.match('connect', line):
+            pass
+        elif regexer.match('paused', line):
+            pass
+        elif regexer.match('redo', line):
+            work = regexer.m.groups()[0]
+            if regexer.match('commit', work):
+                continue
+            for action in 'insert', 'update', 'delete':
+                if regexer.match(action, work):
+                    break
+            else:
+                continue
+            db_node = int(regexer.get('db_node', 0))
+            rel_node = int(regexer.get('rel_node', 0))
+            block = int(regexer.get('block', 0))
+            offset = int(regexer.get('offset', 0))
+            new_block = int(regexer.get('new_block', 0))
+            new_offset = int(regexer.get('new_offset', 0))
+            if db_node != db_oid:
+                continue
+            records += 1
+    return records
+
+
+def parser_run(parser, lines, db_oid):
+    """
+    The line handling of Worker.consume and Worker.apply with LogParser
+    """
+    db_node = str(db_oid)
+    records = 0
+    for line in lines:
+        record = parser.line(line)
+        if record and record[0] == 'redo':
+            work = record[1]
+            if parser.commit(work):
+                continue
+            if parser.heap(work, db_node):
+                records += 1
+    return records
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--lines', type=int, default=100000, help='Number of log lines')
+    argparser.add_argument('--size', type=int, default=10, help='Records per transaction')
+    argparser.add_argument('--foreign', type=float, default=0.2,
+            help='Share of heap records for another database')
+    argparser.add_argument('--repeat', type=int, default=3, help='Number of timing runs')
+    args = argparser.parse_args()
+
+    generator = LogGenerator()
+    lines = list(generator.lines(args.lines, size=args.size, foreign=args.foreign))
+    db_oid = generator.db_node
+
+    regexer, parser = RegExer(), LogParser()
+    expected = regexer_run(regexer, lines, db_oid)
+    found = parser_run(parser, lines, db_oid)
+    if expected != found:
+        raise SystemExit('RegExer found {} records but LogParser {}'.format(expected, found))
+
+    results = {}
+    for name, run, obj in ('RegExer', regexer_run, regexer), ('LogParser', parser_run, parser):
+        best = min(timeit.repeat(lambda: run(obj, lines, db_oid), number=1, repeat=args.repeat))
+        results[name] = best
+        print('{:<10} {:>10.0f} lines/sec'.format(name, len(lines) / best))
+    print('speedup    {:>10.2f}x'.format(results['RegExer'] / results['LogParser']))
+
+
+if __name__ == '__main__':
+    main()
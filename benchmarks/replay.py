@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Replays synthetic slave log output through Worker, with in-memory stand-ins
+for the slave and, unless a history database is given, the history
+database.
+
+    python -m benchmarks.replay --lines 200000
+    python -m benchmarks.replay --mix insert=1 --size 100
+    python -m benchmarks.replay --history-database bench
+    python -m benchmarks.replay --history-database bench --tables 16 --apply-shards 4
+
+A history database gets its tables in the marty_bench schema, which is
+dropped first.
+"""
+
+import time
+import logging
+import argparse
+
+import psycopg2
+
+from history import LogParser, Worker
+from utils import HistoryPopulator, HistoryWriter, ShardedWriter, Stats
+from utils.dbobjects import Schema, Table, Column
+from benchmarks.generator import LogGenerator
+
+logger = logging.getLogger('benchmark')
+logger.addHandler(logging.NullHandler())
+
+
+class FakeInspector(object):
+    """
+    SlaveInspector answering from memory: every tuple exists and every
+    catalog tuple is a new schema, table or column
+    """
+
+    def __init__(self, generator, columns=4):
+        self.db_oid = generator.db_node
+        self.logger = logger
+        self.schema = Schema('(0,1)', 2200, 'bench')
+        self.system_tables = {}
+        for name, rel_node in generator.catalog_nodes.iteritems():
+            self.system_tables[rel_node] = Table(None, None, None, name)
+        self.tabledict = {}
+        for rel_node in generator.rel_nodes:
+            table = Table(self.schema, '(0,{})'.format(rel_node), rel_node, 't{}'.format(rel_node))
+            table.update = 1
+            for number in range(1, columns + 1):
+                table.add_column('(1,{})'.format(number), 'c{}'.format(number), number, 'text', -1)
+            self.tabledict[rel_node] = table
+        self.row = tuple('value {}'.format(number) for number in range(columns))
+        self.fetches = 0
+
+    def invalidate(self, catalog, ctids):
+        pass
+
+    def prefetch(self, catalog, ctids):
+        pass
+
+    def get_schema(self, ctid):
+        return Schema(ctid, 3000, 'schema_{}'.format(ctid.strip('()').replace(',', '_')))
+
+    def get_table(self, ctid):
+        name = 'table_{}'.format(ctid.strip('()').replace(',', '_'))
+        table = Table(self.schema, ctid, 4000, name)
+        table.add_column('(2,1)', 'id', 1, 'int4', -1)
+        return table
+
+    def get_column(self, ctid):
+        table = self.get_table('(0,1)')
+        return Column(table, ctid, 'column_{}'.format(ctid.strip('()').replace(',', '_')), 2, 'text', -1)
+
+    def get_many(self, table, tids, cols=None):
+        self.fetches += 1
+        row = self.row
+        return dict(('({},{})'.format(block, offset), row) for block, offset in tids)
+
+    def get_tables(self, requests):
+        return [self.get_many(table, tids, cols) for table, tids, cols in requests]
+
+    def row_estimate(self, table):
+        # Every tuple exists, no transaction changes a large part of a table
+        return float('inf')
+
+    def resume(self):
+        pass
+
+    def replay_location(self):
+        return None
+
+
+class FakeCursor(object):
+
+    query = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, args=None):
+        pass
+
+    def fetchone(self):
+        return (1,)
+
+    def fetchall(self):
+        return []
+
+
+class FakeConnection(object):
+
+    autocommit = True
+
+    def cursor(self):
+        return FakeCursor()
+
+
+class FakePopulator(HistoryPopulator):
+    """
+    HistoryPopulator in batch mode that drops its batches instead of writing
+    them. The writer calls HistoryPopulator methods, so inserts and deletes
+    are queued as usual and catalog changes go to a connection that does
+    nothing.
+    """
+
+    def __init__(self, stats=None):
+        HistoryPopulator.__init__(self, FakeConnection(), logger=logger,
+                batch=True, stats=stats)
+        self.update_id = 0
+
+    def begin(self):
+        pass
+
+    def update(self, mastertime, lsn=None, complete=True):
+        self.update_id += 1
+        self.lsn = lsn
+
+    def complete_updates(self, update_ids):
+        pass
+
+    def commit(self):
+        self.flush()
+
+    def flush(self):
+        for table, rows in self._inserts.itervalues():
+            self.stats.count('rows_inserted', len(rows))
+        for table, ctids in self._deletes.itervalues():
+            self.stats.count('rows_deleted', len(ctids))
+        self._inserts.clear()
+        self._deletes.clear()
+
+    def get_table(self, ctid):
+        return None
+
+    def get_column(self, ctid):
+        return None
+
+
+class Lines(object):
+    """
+    The readline() interface of LogReader over a list of lines
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+
+    def readline(self):
+        return next(self.lines, '')
+
+
+class TimedWorker(Worker):
+    """
+    Worker recording how long each commit keeps the slave paused
+    """
+
+    def __init__(self, *args, **kwargs):
+        Worker.__init__(self, *args, **kwargs)
+        self.latencies = []
+
+    def apply(self, timestamp, lsn, work):
+        start = time.time()
+        Worker.apply(self, timestamp, lsn, work)
+        self.latencies.append(time.time() - start)
+
+
+def history_connection(args):
+    con = psycopg2.connect(host=args.history_host, port=args.history_port, user=args.history_user,
+            password=args.history_password, database=args.history_database)
+    con.autocommit = True
+    with con.cursor() as curs:
+        curs.execute('CREATE SCHEMA IF NOT EXISTS marty_bench')
+        curs.execute('SET search_path TO marty_bench')
+    return con
+
+
+def history_populator(args, inspector, stats):
+    con = history_connection(args)
+    with con.cursor() as curs:
+        curs.execute('DROP SCHEMA marty_bench CASCADE')
+        curs.execute('CREATE SCHEMA marty_bench')
+    populator = HistoryPopulator(con, logger=logger, batch=args.apply == 'batch',
+            stats=stats)
+    populator.create_tables()
+    populator.update('2014-03-01 09:00:00')
+    for table in inspector.tabledict.itervalues():
+        table.update = populator.update_id
+        populator.add_table(table)
+        populator.create_table(table)
+    return populator
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        mix[kind] = int(weight or 1)
+    return mix
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--lines', type=int, default=100000, help='Number of log lines')
+    argparser.add_argument('--size', type=int, default=10, help='Records per transaction')
+    argparser.add_argument('--mix', type=parse_mix,
+            help='Record kinds and weights, like insert=4,update=2,hot_update=2,delete=1,catalog=0,other=1')
+    argparser.add_argument('--tables', type=int, default=4, help='Number of tables written to')
+    argparser.add_argument('--columns', type=int, default=4, help='Number of columns per table')
+    argparser.add_argument('--foreign', type=float, default=0.0,
+            help='Share of heap records for another database')
+    argparser.add_argument('--seed', type=int, default=0, help='Seed of the generated log')
+    argparser.add_argument('--pipeline-depth', type=int, default=4,
+            help='Commits waiting for their history writes, 0 writes them inline')
+    argparser.add_argument('--apply', choices=('batch', 'row'), default='batch',
+            help='How a history database is written to')
+    argparser.add_argument('--spill-threshold', type=int, default=100000,
+            help='Records of a transaction kept in memory, 0 keeps them all')
+    argparser.add_argument('--apply-shards', type=int, default=1,
+            help='History connections writing different tables at the same time')
+    argparser.add_argument('--history-host', help='Hostname or IP of a history database to write to')
+    argparser.add_argument('--history-port', help='Port number of the history database')
+    argparser.add_argument('--history-user', help='Username for the history database')
+    argparser.add_argument('--history-password', help='Password for the history database')
+    argparser.add_argument('--history-database', help='Name of the history database')
+    args = argparser.parse_args()
+    if args.history_database and args.mix and args.mix.get('catalog'):
+        argparser.error('catalog records can only be replayed without a history database')
+
+    generator = LogGenerator(rel_nodes=tuple(range(16385, 16385 + args.tables)), seed=args.seed)
+    lines = ['LOG:  database system is ready to accept read only connections\n']
+    lines.extend(generator.lines(args.lines, mix=args.mix, size=args.size, foreign=args.foreign))
+
+    stats = Stats()
+    inspector = FakeInspector(generator, columns=args.columns)
+    if args.history_database:
+        populator = history_populator(args, inspector, stats)
+    else:
+        populator = FakePopulator(stats)
+    writer_callback = HistoryWriter
+    if args.apply_shards > 1:
+        if args.history_database:
+            shards = [HistoryPopulator(history_connection(args), logger=logger, batch=args.apply == 'batch',
+                                       stats=stats) for i in range(args.apply_shards)]
+        else:
+            shards = [FakePopulator(stats) for i in range(args.apply_shards)]
+        writer_callback = lambda populator, depth, logger=None, stats=None: ShardedWriter(
+                populator, shards, depth, logger=logger, stats=stats)
+
+    worker = TimedWorker(Lines(lines), LogParser(), lambda timestamp: (None, inspector, populator),
+            depth=args.pipeline_depth, stats=stats, writer_callback=writer_callback,
+            spill_threshold=args.spill_threshold)
+    start = time.time()
+    for i in xrange(len(lines)):
+        worker.consume()
+    worker.close()
+    elapsed = time.time() - start
+
+    latencies = sorted(worker.latencies)
+    records = stats.counters.get('records', 0)
+    print('{:<14} {:>12}'.format('lines', len(lines)))
+    print('{:<14} {:>12}'.format('commits', len(latencies)))
+    print('{:<14} {:>12.3f}'.format('seconds', elapsed))
+    print('{:<14} {:>12.0f}'.format('lines/sec', len(lines) / elapsed))
+    print('{:<14} {:>12.0f}'.format('tuples/sec', records / elapsed))
+    print('{:<14} {:>12.0f}'.format('commits/sec', len(latencies) / elapsed))
+    if latencies:
+        for name, fraction in ('p50', 0.5), ('p95', 0.95), ('p99', 0.99):
+            print('{:<14} {:>12.1f} us'.format('commit ' + name, percentile(latencies, fraction) * 1e6))
+        print('{:<14} {:>12.1f} us'.format('commit max', latencies[-1] * 1e6))
+    write = stats.histograms.get('write')
+    if write and write.count:
+        print('{:<14} {:>12.1f} us'.format('write mean', write.sum / write.count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
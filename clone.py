@@ -28,6 +28,8 @@ def main():
     parser.add_argument('--clone-user', help='Username for the clone database')
     parser.add_argument('--clone-password', help='Password for the clone database')
     parser.add_argument('--clone-database', help='Name of the clone database')
+    parser.add_argument('--lazy', action='store_true',
+            help="Only copy the rows asked for with SELECT view_fetch('schema.table', 'predicate')")
 
     args = parser.parse_args()
 
@@ -53,7 +55,8 @@ def main():
     populator_logger = get_logger('populator')
 
     inspector = HistoryInspector(histcon, logger=inspector_logger)
-    populator = ClonePopulator(clonecon, inspector.update, history, logger=populator_logger)
+    populator = ClonePopulator(clonecon, inspector.update, history, logger=populator_logger,
+            lazy=args.lazy)
     populator.initialize()
     for schema in inspector.schemas():
         populator.create_schema(schema)
@@ -61,6 +64,10 @@ def main():
             inspector.columns(table)
             populator.create_table(table)
     clonecon.commit()
+    if args.lazy:
+        populator_logger.warning("views can only be read after SELECT view_fetch('schema.table'), or with "
+                                 "SET marty.partial_reads = on the rows fetched with "
+                                 "SELECT view_fetch('schema.table', 'predicate')")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import psycopg2
+from utils import HistoryCompactor, get_logger
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history-host', help='Hostname or IP of the history database')
+    parser.add_argument('--history-port', help='Port number for the history database')
+    parser.add_argument('--history-user', help='Username for the history database')
+    parser.add_argument('--history-password', help='Password for the history database')
+    parser.add_argument('--history-database', help='Name of the history database')
+
+    horizon = parser.add_mutually_exclusive_group(required=True)
+    horizon.add_argument('--horizon-update', type=int,
+            help='Remove everything no clone of this update or later can see')
+    horizon.add_argument('--horizon-time',
+            help='Remove everything no clone of the master at this time or later can see')
+
+    parser.add_argument('--batch-size', type=int, default=10000,
+            help='Maximum number of rows removed by one statement')
+    parser.add_argument('--archive', action='store_true',
+            help='Move removed rows and tables to the marty_archive schema instead of deleting them')
+    parser.add_argument('--no-vacuum', action='store_true',
+            help='Do not vacuum the compacted tables')
+
+    args = parser.parse_args()
+
+    history = {
+        'host': args.history_host,
+        'port': args.history_port,
+        'user': args.history_user,
+        'password': args.history_password,
+        'database': args.history_database
+    }
+
+    histcon = psycopg2.connect(**history)
+    histcon.autocommit = True
+
+    compactor = HistoryCompactor(histcon, batch_size=args.batch_size, archive=args.archive,
+            logger=get_logger('compactor'))
+    horizon = compactor.horizon(args.horizon_update, args.horizon_time)
+    if horizon is None:
+        compactor.logger.warning('nothing to compact')
+        return
+
+    removed, dropped, reclaimed = compactor.compact(horizon, vacuum=not args.no_vacuum)
+    for table_name, rows in sorted(removed.iteritems()):
+        print('{}: {} rows'.format(table_name, rows))
+    for table_name, size in sorted(dropped.iteritems()):
+        print('{}: {} bytes'.format(table_name, size))
+    print('reclaimed {} bytes'.format(reclaimed))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import psycopg2
 import sys
 import argparse
 import re
+import json
+import copy
+import time
+import logging
+import tempfile
+import threading
+import Queue
+
+import psycopg2
 
-from utils import SlaveInspector, HistoryPopulator, get_logger
-from utils.dbobjects import Schema
+from utils import (SlaveInspector, HistoryInspector, HistoryPopulator, HistoryWriter,
+        ShardedWriter, LogReader, ConnectionPool, AsyncFetcher, SpillFile, Stats, StatsReporter, Profiler, get_logger)
+from utils.dbobjects import Schema, Column
 
 
 class RegExer(object):
@@ -45,64 +54,759 @@ class RegExer(object):
             return val
 
 
+class LogParser(object):
+    """
+    Classifies slave log lines with a prefix check and at most one regular
+    expression per line. Records are plain tuples:
+
+        ('lastup', timestamp), ('connect',), ('paused',), ('redo', work, lsn)
+
+    and for the work part of a redo record:
+
+        ('commit', timestamp)
+        (action, rel_node, block, offset, new_block, new_offset)
+
+    and for COPY's multi-inserts, whose tuples are at offsets 1 to ntuples
+    when init says the block is a new page:
+
+        ('multi_insert', rel_node, block, ntuples, init, 0)
+    """
+    redo_prefix = 'LOG:  REDO @ '
+    lastup_prefix = 'LOG:  database system was interrupted; last known up at '
+    connect_prefix = 'LOG:  database system is ready to accept read only connections'
+    paused_prefix = 'LOG:  recovery has paused'
+    heap_prefix = 'Heap - '
+    multi_insert_prefix = 'Heap2 - multi-insert'
+    commit_prefix = 'Transaction - commit: '
+
+    CONNECT = ('connect',)
+    PAUSED = ('paused',)
+
+    def __init__(self):
+        self.redo_re = re.compile(r'[0-9A-F]+/[0-9A-F]+; LSN ([0-9A-F]+/[0-9A-F]+): prev [0-9A-F]+/[0-9A-F]+; xid [0-9]+; len [0-9]+(?:; bkpb[0-9]+)?: (.*)')
+        self.heap_re = re.compile(r'(insert|update|hot_update|delete)(?:\(init\))?: rel \d+/(\d+)/(\d+); tid (\d+)/(\d+)(?: xmax \d+ (?:[A-Z_]+ )?; new tid (\d+)/(\d+) xmax \d+)?')
+        self.lastup_re = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+        self.commit_re = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+')
+        self.database_re = re.compile(r'[a-z_]+(?:\(init\))?: rel \d+/(\d+)/')
+        self.multi_insert_re = re.compile(r'( \(init\))?: rel \d+/(\d+)/(\d+); blk (\d+); (\d+) tuples')
+
+    def line(self, line):
+        if line.startswith(self.redo_prefix):
+            m = self.redo_re.match(line, len(self.redo_prefix))
+            if m:
+                return 'redo', m.group(2), m.group(1)
+        elif line.startswith(self.paused_prefix):
+            return self.PAUSED
+        elif line.startswith(self.connect_prefix):
+            return self.CONNECT
+        elif line.startswith(self.lastup_prefix):
+            m = self.lastup_re.match(line, len(self.lastup_prefix))
+            if m:
+                return 'lastup', m.group()
+
+    def commit(self, work):
+        if work.startswith(self.commit_prefix):
+            m = self.commit_re.match(work, len(self.commit_prefix))
+            if m:
+                return 'commit', m.group()
+
+    def database(self, work):
+        """
+        The database oid (as a string) of a heap record, None for anything
+        else
+        """
+        if work.startswith(self.heap_prefix):
+            m = self.database_re.match(work, len(self.heap_prefix))
+            if m:
+                return m.group(1)
+        elif work.startswith(self.multi_insert_prefix):
+            m = self.multi_insert_re.match(work, len(self.multi_insert_prefix))
+            if m:
+                return m.group(2)
+
+    def heap(self, work, db_node):
+        """
+        Parses an insert, update or delete of a heap tuple. Records for other
+        databases than db_node (the oid as a string) are dropped before the
+        rest of the groups are looked at.
+        """
+        if not work.startswith(self.heap_prefix):
+            if work.startswith(self.multi_insert_prefix):
+                return self.multi_insert(work, db_node)
+            return
+        m = self.heap_re.match(work, len(self.heap_prefix))
+        if not m or m.group(2) != db_node:
+            return
+        action, _, rel_node, block, offset, new_block, new_offset = m.groups()
+        if action == 'delete' or action == 'insert':
+            return action, int(rel_node), int(block), int(offset), 0, 0
+        if new_block is None:
+            return
+        return 'update', int(rel_node), int(block), int(offset), int(new_block), int(new_offset)
+
+    def multi_insert(self, work, db_node):
+        m = self.multi_insert_re.match(work, len(self.multi_insert_prefix))
+        if not m or m.group(2) != db_node:
+            return
+        init, _, rel_node, block, ntuples = m.groups()
+        return 'multi_insert', int(rel_node), int(block), int(ntuples), bool(init), 0
+
+
+def parse_lsn(lsn):
+    """
+    Turns a WAL position like 2A/5F01C8 into a number
+    """
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+timestamp_re = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)?')
+
+
+def decoding_timestamp(value):
+    """
+    A commit time from logical decoding like 2014-03-01 10:00:00.123+01
+    without its time zone, as the slave log has it
+    """
+    if value:
+        m = timestamp_re.match(value)
+        if m:
+            return m.group()
+
+
+class TestDecodingParser(object):
+    """
+    Reads the output of the test_decoding plugin as pg_recvlogical writes
+    it, with include-timestamp on for the commit times. line() returns
+    (timestamp, lsn, changes) once a transaction has committed, lsn is
+    always None as the plugin does not print it. Changes are
+
+        (action, schema, table, new, old)
+
+    where new and old are dicts of the columns printed for the new tuple
+    and the old key. Unchanged TOAST values are left out.
+    """
+    table_prefix = 'table '
+
+    def __init__(self):
+        self.table_re = re.compile(r'("(?:[^"]|"")*"|[^."]+)\.("(?:[^"]|"")*"|[^:"]+): (INSERT|UPDATE|DELETE|TRUNCATE):')
+        self.column_re = re.compile(r' (?:(old-key|new-tuple):|("(?:[^"]|"")*"|[^\[ ]+)\[.*?\]:(null|\'(?:[^\']|\'\')*\'|[^ ]*))')
+        self.commit_re = re.compile(r'COMMIT(?: \d+)?(?: \(at (.*)\))?')
+        self._changes = []
+        self._partial = None
+
+    def line(self, line):
+        if self._partial:
+            line = self._partial + line
+            self._partial = None
+        if line.startswith(self.table_prefix):
+            # Values with line breaks span several lines
+            if line.count("'") % 2:
+                self._partial = line
+                return
+            change = self.change(line[:-1] if line.endswith('\n') else line)
+            if change:
+                self._changes.append(change)
+        elif line.startswith('BEGIN'):
+            self._changes = []
+        elif line.startswith('COMMIT'):
+            m = self.commit_re.match(line)
+            changes = self._changes
+            self._changes = []
+            return decoding_timestamp(m and m.group(1)), None, changes
+
+    def change(self, line):
+        m = self.table_re.match(line, len(self.table_prefix))
+        if not m:
+            return
+        schema, table, action = m.groups()
+        action = action.lower()
+        if action == 'truncate':
+            return action, self.identifier(schema), self.identifier(table), None, None
+
+        new = {}
+        old = {}
+        values = old if action == 'delete' else new
+        pos = m.end()
+        m = self.column_re.match(line, pos)
+        while m:
+            marker, name, value = m.groups()
+            if marker:
+                values = old if marker == 'old-key' else new
+            elif value != 'unchanged-toast-datum':
+                values[self.identifier(name)] = self.value(value)
+            pos = m.end()
+            m = self.column_re.match(line, pos)
+        return action, self.identifier(schema), self.identifier(table), new or None, old or None
+
+    def identifier(self, name):
+        if name.startswith('"'):
+            return name[1:-1].replace('""', '"')
+        return name
+
+    def value(self, value):
+        if value == 'null':
+            return None
+        if value.startswith("'"):
+            return value[1:-1].replace("''", "'")
+        if value.startswith("B'"):
+            return value[2:-1]
+        return value
+
+
+class Wal2JsonParser(object):
+    """
+    Reads the output of the wal2json plugin in format 1, a JSON document
+    per transaction, with include-timestamp and include-lsn on for the
+    commit times and restart positions. line() returns transactions like
+    TestDecodingParser.
+    """
+
+    def __init__(self):
+        self._lines = []
+
+    def line(self, line):
+        if not self._lines and not line.lstrip().startswith('{'):
+            return
+        self._lines.append(line)
+        if not line.rstrip().endswith('}'):
+            return
+        try:
+            document = json.loads(''.join(self._lines))
+        except ValueError:
+            # A document written over several lines
+            return
+        self._lines = []
+
+        changes = []
+        for change in document.get('change', ()):
+            action = change.get('kind')
+            if action not in ('insert', 'update', 'delete'):
+                continue
+            new = old = None
+            if 'columnnames' in change:
+                new = dict(zip(change['columnnames'], change['columnvalues']))
+            if 'oldkeys' in change:
+                old = dict(zip(change['oldkeys']['keynames'], change['oldkeys']['keyvalues']))
+            changes.append((action, change['schema'], change['table'], new, old))
+        return decoding_timestamp(document.get('timestamp')), document.get('nextlsn'), changes
+
+
+class Version(object):
+    """
+    What delta storage remembers of a tuple it wrote: a hash of each column,
+    the columns changed since the last full version of the row and that
+    full version, which the populator fills in as (ctid, update id) when it
+    writes it
+    """
+    __slots__ = ('digests', 'changed', 'base')
+
+    def __init__(self, digests, changed=frozenset(), base=None):
+        self.digests = digests
+        self.changed = changed
+        self.base = base
+
 
 class Worker(object):
-    def __init__(self, infile, regexer, connect_callback):
+    """
+    Replays the slave log into the history database in three stages: log
+    lines are parsed as they come in, when a transaction has committed its
+    tuples are fetched from the paused slave and the resulting changes are
+    handed to a HistoryWriter. The slave is resumed as soon as the reads are
+    done, while the history writes may still be in flight.
+
+    A transaction of more than spill_threshold records is parsed as it
+    comes in and its records are written to a SpillFile. At commit they are
+    read back and applied spill_threshold records at a time, in a single
+    history transaction.
+
+    A table with at least bulk_threshold records in a transaction, and
+    records for at least bulk_fraction of its rows, is not replayed tuple
+    by tuple. All its rows are copied from the slave and diffed against
+    the open versions in the history database instead. So is a table COPY
+    added tuples to on a page that was not new, the multi-insert record
+    does not say which offsets they got.
+    """
+    bulk_fraction = 0.25
+
+    def __init__(self, infile, parser, connect_callback, depth=4, stats=None, delta=False,
+            delta_cache=100000, writer_callback=HistoryWriter, spill_threshold=100000,
+            bulk_threshold=10000):
         self.infile = infile
-        self.regexer = regexer
+        self.parser = parser
         self.connect_callback = connect_callback
+        self.writer_callback = writer_callback
+        self.depth = depth
+        self.spill_threshold = spill_threshold
+        self._spill = SpillFile()
+        self.bulk_threshold = bulk_threshold
+        # Records per rel_node of the spilled part of a transaction
+        self._counts = {}
+        # rel_nodes with multi-inserts that must be diffed as a whole
+        self._copied = set()
+        # Tuples per table not visible at commit, logged once per commit
+        self._missing = {}
+        self.stats = stats or Stats()
+        # Delta storage, updates of tuples in the version cache only store
+        # the changed columns
+        self.delta = delta
+        self.delta_cache = delta_cache
+        self._versions = {}
+        self._version_count = 0
+        self._fetched = {}
         self.inspector = None
         self.populator = None
+        self.writer = None
         self.slavecon = None
         self._work = []
+        self._changes = []
         self._commited = False
         self._timestamp = None
+        self._lsn = None
+        self._checkpoint = None
+        self._db_node = None
+        # Kept locally and added to the stats once per transaction
+        self._lines = 0
+        self._parse_time = 0.0
+        self._paused_at = None
 
     def consume(self):
-        self.infile.flush()
         line = self.infile.readline()
-        if self.regexer.match('lastup', line):
-            self._timestamp = self.regexer.m.groupdict()['timestamp']
-        elif self.regexer.match('connect', line):
-            self.slavecon, self.inspector, self.populator = self.connect_callback(self._timestamp)
-            self.inspector.resume()
-            self._timestamp = None
-        elif self.regexer.match('paused', line):
-            if self.inspector:
-                self.inspector.resume()
-        elif self.regexer.match('redo', line):
-            work = self.regexer.m.groups()[0]
-            if self.regexer.match('commit', work):
+        start = time.time()
+        record = self.parser.line(line)
+        self._parse_time += time.time() - start
+        self._lines += 1
+        if not record:
+            return
+
+        if record[0] == 'redo':
+            work = record[1]
+            commit = self.parser.commit(work)
+            if commit:
                 if self.inspector:
                     self._commited = True
-                    self._timestamp = self.regexer.m.groupdict()['timestamp']
+                    self._timestamp = commit[1]
+                    self._lsn = record[2]
             elif self._commited:
-                self.populator.update(self._timestamp)
-                for w in self._work:
-                    self.work(w)
-                self._work = []
+                self.commit(self._timestamp, self._lsn)
                 self._commited = False
                 self._timestamp = None
-            self._work.append(work)
+                self._lsn = None
+            self.collect(work)
+        elif record[0] == 'paused':
+            self.resume()
+        elif record[0] == 'connect':
+            self.connect(self._timestamp)
+            self.inspector.resume()
+            self._timestamp = None
+        elif record[0] == 'lastup':
+            self._timestamp = record[1]
 
-    def work(self, work):
-        for action in 'insert', 'update', 'delete':
-            if self.regexer.match(action, work):
-                break
-        else:
-            # If the work is not an insert, update or delete action we leave
-            # (we only run the else part if the for loop does not break)
-            return
+    def connect(self, timestamp):
+        """
+        Sets up the slave and history connections once the slave accepts
+        connections, leaving the slave paused
+        """
+        self.close()
+        self.slavecon, self.inspector, self.populator = self.connect_callback(timestamp)
+        self.writer = self.writer_callback(self.populator, self.depth, logger=self.populator.logger,
+                stats=self.stats)
+        self._db_node = str(self.inspector.db_oid)
+        self._versions = {}
+        self._version_count = 0
+        # Commits up to the checkpoint are already in the history database
+        self._checkpoint = self.populator.lsn and parse_lsn(self.populator.lsn)
 
-        db_node = int(self.regexer.get('db_node', 0))
-        rel_node = int(self.regexer.get('rel_node', 0))
-        block = int(self.regexer.get('block', 0))
-        offset = int(self.regexer.get('offset', 0))
-        new_block = int(self.regexer.get('new_block', 0))
-        new_offset = int(self.regexer.get('new_offset', 0))
+    def collect(self, work):
+        """
+        Adds the work part of a redo record to the next commit
+        """
+        self._work.append(work)
+        if len(self._work) >= self.spill_threshold > 0:
+            self.spill()
 
-        if db_node != self.inspector.db_oid:
+    def spill(self):
+        """
+        Parses the work collected so far and moves its records to the spill
+        file. Work from before the connection waits for the database oid.
+        """
+        if self._db_node is None:
             return
+        start = time.time()
+        records = self.records(self._work)
+        self._parse_time += time.time() - start
+        self._spill.write(records)
+        if self.bulk_threshold:
+            self.count(records, self._counts)
+        self.stats.count('records_spilled', len(records))
+        self._work = []
+
+    def commit(self, timestamp, lsn):
+        """
+        Applies the work collected since the last commit, unless the history
+        database already has it
+        """
+        if self._checkpoint is None or parse_lsn(lsn) > self._checkpoint:
+            self.apply(timestamp, lsn, self._work)
+        else:
+            self.stats.count('commits_skipped')
+        self._work = []
+        self._spill.close()
+        self._counts = {}
+        self._copied = set()
+
+    def resume(self):
+        if self.inspector:
+            self.inspector.resume()
+            if self._paused_at:
+                self.stats.observe('pause', time.time() - self._paused_at)
+                self._paused_at = None
+
+    def close(self):
+        """
+        Waits for the history writes in flight
+        """
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def apply(self, timestamp, lsn, work):
+        # The slave paused on the commit and stays paused until the reads are done
+        self._paused_at = start = time.time()
+        stats = self.stats
+        records = self.records(work)
+        stats.observe('parse', self._parse_time + time.time() - start)
+        stats.count('lines', self._lines)
+        self._lines = 0
+        self._parse_time = 0.0
+
+        bulk = ()
+        if self._copied or self.bulk_threshold and self._spill.count + len(records) >= self.bulk_threshold:
+            self.count(records, self._counts)
+            bulk = self.bulk_tables(self._counts)
+
+        if self._spill.count:
+            self._spill.write(records)
+            chunks = self._spill.chunks(self.spill_threshold)
+            self.writer.apply_chunks(timestamp, lsn, self.chunk_changes(chunks, bulk))
+        else:
+            changes = self.changes(records, bulk)
+            if bulk:
+                changes.extend(self.bulk_changes(bulk))
+            with stats.timer('submit'):
+                self.writer.submit(timestamp, lsn, changes)
+        stats.count('commits')
+        if self._missing:
+            missing = sum(self._missing.itervalues())
+            stats.count('tuples_missing', missing)
+            self.inspector.logger.warning('{} tuples not visible at commit {} were not inserted: {}'.format(
+                missing, timestamp, ', '.join('{} of {}'.format(count, name)
+                                              for name, count in sorted(self._missing.iteritems()))))
+            self._missing = {}
+        stats.gauge('writer_backlog', self.writer.backlog)
+        backlog = getattr(self.infile, 'backlog', None)
+        if backlog is not None:
+            stats.gauge('log_backlog', backlog)
+
+    def chunk_changes(self, chunks, bulk):
+        for chunk in chunks:
+            yield self.changes(chunk, bulk)
+        if bulk:
+            yield self.bulk_changes(bulk)
+
+    def changes(self, records, bulk=()):
+        """
+        Turns the records of a transaction into changes for the history
+        writer, leaving out those of the rel_nodes in bulk
+        """
+        stats = self.stats
+        stats.count('records', len(records))
+        if bulk:
+            records = [record for record in records if record[1] not in bulk]
+        coalesced = self.coalesce(records)
+        stats.count('records_coalesced', len(records) - len(coalesced))
+        records = coalesced
+
+        with stats.timer('fetch'):
+            self.fetch_catalog(records)
+            rows = self.fetch(records)
+        self._changes = []
+        for record in records:
+            self.work(record, rows)
+        changes = self._changes
+        self._changes = []
+        return changes
+
+    def count(self, records, counts):
+        for record in records:
+            counts[record[1]] = counts.get(record[1], 0) + 1
+
+    def bulk_tables(self, counts):
+        """
+        The rel_nodes of the tables to diff as a whole, from the number of
+        records of each rel_node in a transaction
+        """
+        bulk = set()
+        for rel_node, count in counts.iteritems():
+            table = self.inspector.tabledict.get(rel_node)
+            if table and rel_node in self._copied:
+                bulk.add(rel_node)
+            elif (table and self.bulk_threshold and count >= self.bulk_threshold
+                    and count >= self.bulk_fraction * self.inspector.row_estimate(table)):
+                bulk.add(rel_node)
+        return bulk
+
+    def bulk_changes(self, bulk):
+        """
+        Copies the rows of the tables in bulk from the paused slave to
+        temporary files, the history writer diffs them
+        """
+        self._changes = []
+        for rel_node in sorted(bulk):
+            table = self.inspector.tabledict[rel_node]
+            self.inspector.logger.info('diffing table {} as a whole, {} records'.format(
+                table.long_name, self._counts[rel_node]))
+            rows = tempfile.TemporaryFile(prefix='marty-bulk-')
+            with self.stats.timer('fetch'):
+                self.inspector.copy_rows(table, rows)
+            versions = self._versions.pop(table, None)
+            if versions:
+                self._version_count -= len(versions)
+            self.change(HistoryPopulator.bulk_diff, table, rows)
+            self.stats.count('tables_bulk')
+        changes = self._changes
+        self._changes = []
+        return changes
+
+    def change(self, function, *args):
+        """
+        Queues function(populator, *args) for the history writer
+        """
+        self._changes.append((function, args))
+
+    def parse(self, work):
+        return self.parser.heap(work, self._db_node)
+
+    def records(self, work):
+        """
+        Parses work into heap records. The multi-inserts of COPY into new
+        pages become inserts of each tuple, the tables of the others are
+        diffed as a whole.
+        """
+        records = [record for record in (self.parse(w) for w in work) if record]
+        if not any(record[0] == 'multi_insert' for record in records):
+            return records
+        expanded = []
+        for record in records:
+            if record[0] != 'multi_insert':
+                expanded.append(record)
+            elif record[4]:
+                expanded.extend(('insert', record[1], record[2], offset, 0, 0)
+                                for offset in range(1, record[3] + 1))
+            else:
+                self._copied.add(record[1])
+                self._counts[record[1]] = self._counts.get(record[1], 0) + record[3]
+        return expanded
+
+    def coalesce(self, records):
+        """
+        Collapses the records of each tuple chain in a transaction to the one
+        net change seen at commit: an insert followed by updates is an
+        insert of the last tuple, updates followed by a delete are a delete
+        of the first one and an insert followed by a delete is nothing.
+        Catalog records are kept in place and no chain crosses them.
+        """
+        result = []
+        chains = []
+        current = {}
+
+        def flush():
+            for rel_node, origin, tid in chains:
+                if origin is None and tid is not None:
+                    result.append(('insert', rel_node) + tid + (0, 0))
+                elif origin is not None and tid is None:
+                    result.append(('delete', rel_node) + origin + (0, 0))
+                elif origin is not None:
+                    result.append(('update', rel_node) + origin + tid)
+            del chains[:]
+            current.clear()
+
+        system_tables = self.inspector.system_tables
+        for record in records:
+            action, rel_node, block, offset, new_block, new_offset = record
+            if rel_node in system_tables:
+                flush()
+                result.append(record)
+                continue
+            # A chain is [rel_node, first tid or None if inserted, last tid or None if deleted]
+            if action == 'insert':
+                chain = [rel_node, None, (block, offset)]
+                chains.append(chain)
+            else:
+                chain = current.pop((rel_node, block, offset), None)
+                if chain is None:
+                    chain = [rel_node, (block, offset), None]
+                    chains.append(chain)
+                chain[2] = (new_block, new_offset) if action == 'update' else None
+            if chain[2] is not None:
+                current[(rel_node,) + chain[2]] = chain
+        flush()
+        return result
+
+    def fetch_catalog(self, records):
+        """
+        Drops the cached catalog rows the transaction touched and loads the
+        new ones from the slave, one query per catalog
+        """
+        touched = {}
+        new = {}
+        system_tables = self.inspector.system_tables
+        for action, rel_node, block, offset, new_block, new_offset in records:
+            if rel_node not in system_tables:
+                continue
+            name = system_tables[rel_node].name
+            ctid = self.ctid(block, offset)
+            touched.setdefault(name, set()).add(ctid)
+            if action == 'insert':
+                new.setdefault(name, set()).add(ctid)
+            elif action == 'update':
+                new_ctid = self.ctid(new_block, new_offset)
+                touched[name].add(new_ctid)
+                new.setdefault(name, set()).add(new_ctid)
+
+        if touched and self._versions:
+            # Column hashes are no good once a table changes
+            self._versions = {}
+            self._version_count = 0
+        for name, ctids in touched.iteritems():
+            self.inspector.invalidate(name, ctids)
+        for name, ctids in new.iteritems():
+            self.inspector.prefetch(name, ctids)
+
+    def fetch(self, records):
+        """
+        Fetches every new tuple of a transaction from the slave, one query
+        per table. With a fetcher the queries for different tables run side
+        by side. Returns a dict of {rel_node: {ctid: row}}.
+        """
+        tids = {}
+        updates = {}
+        for action, rel_node, block, offset, new_block, new_offset in records:
+            if rel_node not in self.inspector.tabledict:
+                continue
+            if action == 'insert':
+                tids.setdefault(rel_node, set()).add((block, offset))
+            elif action == 'update':
+                version = self.delta and self._versions.get(
+                        self.inspector.tabledict[rel_node], {}).get(self.ctid(block, offset))
+                if version:
+                    updates.setdefault(rel_node, {})[(new_block, new_offset)] = version
+                else:
+                    tids.setdefault(rel_node, set()).add((new_block, new_offset))
+
+        self._fetched = {}
+        full = [(rel_node, self.inspector.tabledict[rel_node], tidset) for rel_node, tidset in tids.iteritems()]
+        delta = [(rel_node, self.inspector.tabledict[rel_node], versions)
+                 for rel_node, versions in updates.iteritems()]
+        requests = [(table, tidset, self.full_columns(table)) for rel_node, table, tidset in full]
+        requests.extend((table, versions.keys(), self.digest_columns(table))
+                        for rel_node, table, versions in delta)
+        results = self.inspector.get_tables(requests)
+
+        rows = {}
+        for (rel_node, table, tidset), fetched in zip(full, results):
+            rows[rel_node] = self.full_rows(table, fetched)
+        if delta:
+            for rel_node, delta_rows in self.fetch_delta(delta, results[len(full):]).iteritems():
+                rows.setdefault(rel_node, {}).update(delta_rows)
+        return rows
+
+    def digest_columns(self, table):
+        return ['md5("{}"::text)'.format(column.name) for column in table.columns]
+
+    def full_columns(self, table):
+        """
+        The columns fetched for whole tuples, with delta storage along with
+        the hashes of the columns
+        """
+        if not self.delta:
+            return None
+        return ['"{}"'.format(column.name) for column in table.columns] + self.digest_columns(table)
+
+    def full_rows(self, table, fetched):
+        if not self.delta:
+            return fetched
+        count = len(table.columns)
+        rows = {}
+        for ctid, row in fetched.iteritems():
+            rows[ctid] = row[:count]
+            self._fetched[table, ctid] = Version(tuple(hash(digest) for digest in row[count:]))
+        return rows
+
+    def fetch_delta(self, updates, digests):
+        """
+        Fetches the updated tuples of rows in the version cache given their
+        column hashes: only the columns changed since the last full version.
+        Rows with more than half their columns changed are fetched whole
+        again. Returns a dict of {rel_node: {ctid: row}}.
+        """
+        rows = {}
+        requests = []
+        pending = []
+        for (rel_node, table, versions), table_digests in zip(updates, digests):
+            full, changed = self.changed_columns(table, versions, table_digests)
+            rows[rel_node] = {}
+            if full:
+                requests.append((table, full, self.full_columns(table)))
+                pending.append((rel_node, table, None, None))
+            needed = sorted(set().union(*changed.values()))
+            if changed and needed:
+                requests.append((table, changed.keys(), ['"{}"'.format(table.columns[i].name) for i in needed]))
+                pending.append((rel_node, table, changed, needed))
+            elif changed:
+                fetched = dict((self.ctid(*tid), ()) for tid in changed)
+                rows[rel_node].update(self.delta_rows(table, changed, needed, fetched))
+
+        for (rel_node, table, changed, needed), fetched in zip(pending, self.inspector.get_tables(requests)):
+            if changed is None:
+                rows[rel_node].update(self.full_rows(table, fetched))
+            else:
+                rows[rel_node].update(self.delta_rows(table, changed, needed, fetched))
+        return rows
+
+    def changed_columns(self, table, versions, digests):
+        """
+        Splits updated tuples into those to fetch whole and a dict of the
+        changed column numbers of the others
+        """
+        columns = table.columns
+        full = set()
+        changed = {}
+        for (block, offset), version in versions.iteritems():
+            ctid = self.ctid(block, offset)
+            if ctid not in digests:
+                continue
+            new = tuple(hash(digest) for digest in digests[ctid])
+            columns_changed = version.changed.union(
+                    i for i, (old, digest) in enumerate(zip(version.digests, new)) if old != digest)
+            if len(columns_changed) * 2 > len(columns) or len(version.digests) != len(new):
+                full.add((block, offset))
+            else:
+                changed[(block, offset)] = columns_changed
+                self._fetched[table, ctid] = Version(new, columns_changed, version.base)
+        return full, changed
+
+    def delta_rows(self, table, changed, needed, fetched):
+        rows = {}
+        for (block, offset), columns_changed in changed.iteritems():
+            ctid = self.ctid(block, offset)
+            values = dict(zip(needed, fetched[ctid]))
+            rows[ctid] = tuple(values[i] if i in columns_changed else None for i in range(len(table.columns)))
+        self.stats.count('delta_rows', len(changed))
+        return rows
+
+    def work(self, record, rows):
+        action, rel_node, block, offset, new_block, new_offset = record
 
         if rel_node in self.inspector.system_tables:
             table = self.inspector.system_tables[rel_node]
@@ -118,10 +822,14 @@ class Worker(object):
         if not table:
             return
 
+        table_rows = rows.get(rel_node, {})
         if action == 'insert':
-            self.insert(table, block, offset)
+            ctid = self.ctid(block, offset)
+            self.insert(table, block, offset, table_rows.get(ctid), self._fetched.get((table, ctid)))
         elif action == 'update':
-            self.update(table, block, offset, new_block, new_offset)
+            ctid = self.ctid(new_block, new_offset)
+            self.update(table, block, offset, new_block, new_offset, table_rows.get(ctid),
+                    self._fetched.get((table, ctid)))
         elif action == 'delete':
             self.delete(table, block, offset)
 
@@ -131,68 +839,472 @@ class Worker(object):
     def schema_change(self, action, block, offset, new_block, new_offset):
         if action == 'insert':
             schema = self.inspector.get_schema(self.ctid(block, offset))
-            self.populator.add_schema(schema)
+            self.change(HistoryPopulator.add_schema, schema)
         elif action == 'update':
             schema = self.inspector.get_schema(self.ctid(new_block, new_offset))
-            self.populator.add_schema(schema)
-            self.populator.remove_schema(self.ctid(block, offset))
+            self.change(HistoryPopulator.add_schema, schema)
+            self.change(HistoryPopulator.remove_schema, self.ctid(block, offset))
         elif action == 'delete':
-            self.populator.remove_schema(self.ctid(block, offset))
+            self.change(HistoryPopulator.remove_schema, self.ctid(block, offset))
 
     def table_change(self, action, block, offset, new_block, new_offset):
         if action == 'insert':
             table = self.inspector.get_table(self.ctid(block, offset))
             if table:
-                self.populator.add_table(table)
-                self.populator.create_table(table)
+                self.change(HistoryPopulator.add_table, table)
+                self.change(HistoryPopulator.create_table, table)
         elif action == 'update':
             table = self.inspector.get_table(self.ctid(new_block, new_offset))
             if table:
-                self.populator.add_table(table)
-            self.populator.remove_table(self.ctid(block, offset))
+                self.change(HistoryPopulator.add_table, table)
+            self.change(HistoryPopulator.remove_table, self.ctid(block, offset))
         elif action == 'delete':
-            table = self.populator.get_table(self.ctid(block, offset))
-            if table:
-                self.populator.delete_all(table)
-            self.populator.remove_table(self.ctid(block, offset))
+            self.change(drop_table, self.ctid(block, offset))
 
     def column_change(self, action, block, offset, new_block, new_offset):
-        update = self.populator.update_id
         if action == 'insert':
-            column = self.inspector.get_column(self.ctid(block, offset), update=update)
+            column = self.inspector.get_column(self.ctid(block, offset))
             if column:
-                self.populator.add_column(column)
-                self.populator.add_data_column(column)
+                self.change(add_column, column)
         if action == 'update':
-            old_column = self.populator.get_column(self.ctid(block, offset))
-            column = self.inspector.get_column(self.ctid(new_block, new_offset),
-                    update=update, internal_name=old_column.internal_name)
-            if column:
-                self.populator.add_column(column)
-            self.populator.remove_column(self.ctid(block, offset))
+            column = self.inspector.get_column(self.ctid(new_block, new_offset))
+            self.change(update_column, column, self.ctid(block, offset))
         if action == 'delete':
-            self.populator.remove_column(self.ctid(block, offset))
+            self.change(HistoryPopulator.remove_column, self.ctid(block, offset))
 
-    def insert(self, table, block, offset):
-        row = self.inspector.get(table, block, offset)
-        self.populator.insert(table, block, offset, row)
+    def insert(self, table, block, offset, row, version=None):
+        # Chains of changes to a tuple are coalesced, so it is only gone if
+        # a record of it is missing or another transaction's was mixed in
+        if row is None:
+            self._missing[table.long_name] = self._missing.get(table.long_name, 0) + 1
+            self.inspector.logger.debug('tuple ({},{}) of {} is not visible at commit, not inserting it'.format(
+                block, offset, table.long_name))
+            return
+        if version is None:
+            self.change(HistoryPopulator.insert, table, block, offset, row)
+            return
+
+        if self._version_count >= self.delta_cache:
+            self._versions = {}
+            self._version_count = 0
+        self._versions.setdefault(table, {})[self.ctid(block, offset)] = version
+        self._version_count += 1
+        if version.base is None:
+            version.base = []
+            self.change(HistoryPopulator.insert, table, block, offset, row, version.base)
+        else:
+            changed = [table.columns[i].number for i in sorted(version.changed)]
+            self.change(HistoryPopulator.insert_delta, table, block, offset, row, changed, version.base)
 
-    def update(self, table, block, offset, new_block, new_offset):
+    def update(self, table, block, offset, new_block, new_offset, row, version=None):
         self.delete(table, block, offset)
-        self.insert(table, new_block, new_offset)
+        self.insert(table, new_block, new_offset, row, version)
 
     def delete(self, table, block, offset):
-        self.populator.delete(table, block, offset)
+        if self._versions:
+            versions = self._versions.get(table)
+            if versions and versions.pop(self.ctid(block, offset), None):
+                self._version_count -= 1
+        self.change(HistoryPopulator.delete, table, block, offset)
+
+
+class DecodingWorker(object):
+    """
+    Replays logical decoding output into the history database. Row images
+    come with the stream, so nothing is read from the source database but
+    its catalog, to bootstrap and when a table or column shows up that the
+    history database does not have yet. Decoded rows have no ctid, their
+    versions are closed by the key logical decoding identifies them with.
+
+    Dropped tables and columns and other DDL are not in the stream and are
+    not replayed. Commits up to the LSN of the last update are skipped, the
+    bootstrap's is the consistent point of the slot it created. Only
+    wal2json output has LSNs, so only it can be resumed from.
+    """
+    TRUNCATE = 'truncate'
+
+    def __init__(self, infile, parser, connect_callback, depth=4, stats=None, logger=None,
+            writer_callback=HistoryWriter):
+        self.infile = infile
+        self.parser = parser
+        self.connect_callback = connect_callback
+        self.writer_callback = writer_callback
+        self.depth = depth
+        self.stats = stats or Stats()
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger()
+            self.logger.addHandler(logging.NullHandler())
+        self.inspector = None
+        self.populator = None
+        self.writer = None
+        self._tables = {}
+        self._columns = {}
+        self._keys = {}
+        self._unidentified = set()
+        self._schemas = set()
+        self._indexed = set()
+        self._changes = []
+        self._checkpoint = None
+        self._lines = 0
+
+    def consume(self):
+        if self.inspector is None:
+            self.connect()
+        line = self.infile.readline()
+        self._lines += 1
+        transaction = self.parser.line(line)
+        if not transaction:
+            return
+        timestamp, lsn, changes = transaction
+        if not changes:
+            return
+        if lsn and self._checkpoint is not None and parse_lsn(lsn) <= self._checkpoint:
+            self.stats.count('commits_skipped')
+            return
+        self.apply(timestamp or time.strftime('%Y-%m-%d %H:%M:%S'), lsn, changes)
+
+    def connect(self):
+        self.close()
+        _, self.inspector, self.populator = self.connect_callback(time.strftime('%Y-%m-%d %H:%M:%S'))
+        self.writer = self.writer_callback(self.populator, self.depth, logger=self.populator.logger,
+                stats=self.stats)
+        self._tables = {}
+        self._columns = {}
+        for table in self.inspector.tabledict.itervalues():
+            self.add(table)
+        history = HistoryInspector(self.populator.con, logger=self.logger)
+        self._schemas = set(schema.oid for schema in history.schemas())
+        self._keys = {}
+        self._indexed = set()
+        self._checkpoint = self.populator.lsn and parse_lsn(self.populator.lsn)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def add(self, table):
+        name = (table.schema.name, table.name)
+        self._tables[name] = table
+        self._columns[name] = set(column.name for column in table.columns)
+
+    def apply(self, timestamp, lsn, changes):
+        stats = self.stats
+        stats.count('lines', self._lines)
+        stats.count('records', len(changes))
+        self._lines = 0
+
+        self._changes = []
+        chains = self.coalesce(changes)
+        stats.count('records_coalesced', len(changes) - len(chains))
+        for table, origin, values in chains:
+            if origin is self.TRUNCATE:
+                self.change(HistoryPopulator.delete_all, table)
+                continue
+            key = origin and self.key_columns(table, origin)
+            if values is not None:
+                row = []
+                unchanged = []
+                for i, column in enumerate(table.columns):
+                    if column.name in values:
+                        row.append(values[column.name])
+                    else:
+                        row.append(None)
+                        unchanged.append(i)
+                self.change(HistoryPopulator.insert_version, table, row, key, unchanged if key else ())
+            if origin is not None:
+                if not key:
+                    self.logger.warning('cannot close a version of {} without a key'.format(table.long_name))
+                    continue
+                if table.oid not in self._indexed:
+                    self._indexed.add(table.oid)
+                    self.change(HistoryPopulator.create_key_index, table, [column for column, value in key])
+                self.change(HistoryPopulator.delete_key, table, key)
+
+        with stats.timer('submit'):
+            self.writer.submit(timestamp, lsn, self._changes)
+        self._changes = []
+        stats.count('commits')
+        stats.gauge('writer_backlog', self.writer.backlog)
+        backlog = getattr(self.infile, 'backlog', None)
+        if backlog is not None:
+            stats.gauge('log_backlog', backlog)
+
+    def change(self, function, *args):
+        self._changes.append((function, args))
+
+    def coalesce(self, changes):
+        """
+        Collapses the changes of each row in a transaction to its net change,
+        a list of (table, key before the transaction or None if inserted,
+        values at commit or None if deleted). Values of unchanged columns are
+        carried over from earlier changes of the row.
+        """
+        chains = []
+        current = {}
+        for action, schema, name, new, old in changes:
+            table = self.table(schema, name, new)
+            if table is None:
+                continue
+            if action == self.TRUNCATE:
+                for chain in chains:
+                    if chain[0] is table:
+                        chain[2] = None
+                current = dict(item for item in current.iteritems() if item[1][0] is not table)
+                chains.append([table, self.TRUNCATE, None])
+                continue
+
+            if action == 'insert':
+                chain = [table, None, new]
+                chains.append(chain)
+            else:
+                origin = self.origin(table, old, new)
+                if origin is None:
+                    self.unidentified(table)
+                    continue
+                chain = current.pop((table.oid, origin), None)
+                if chain is None:
+                    chain = [table, origin, None]
+                    chains.append(chain)
+                if action == 'update':
+                    if chain[2]:
+                        values = dict(chain[2])
+                        values.update(new)
+                        new = values
+                    chain[2] = new
+                else:
+                    chain[2] = None
+            key = chain[2] is not None and self.key(table, chain[2])
+            if key:
+                current[(table.oid, key)] = chain
+        return chains
+
+    def table(self, schema, name, values=None):
+        """
+        The table changes are written to, added to the history database
+        first if it is new and brought up to date if columns were added
+        """
+        table = self._tables.get((schema, name))
+        if table is None:
+            table = self.inspector.find_table(schema, name)
+            if table is None:
+                self.logger.warning('table {}.{} not found'.format(schema, name))
+                return None
+            self.inspector.columns(table)
+            if table.schema.oid not in self._schemas:
+                self._schemas.add(table.schema.oid)
+                self.change(HistoryPopulator.add_schema, table.schema)
+            self.change(HistoryPopulator.add_table, table)
+            self.change(HistoryPopulator.create_table, table)
+            self.add(table)
+        elif values and not self._columns[(schema, name)].issuperset(values):
+            table = self.add_columns(table, values)
+        return table
+
+    def add_columns(self, table, values):
+        # Changes still queued for the writer keep the table as it was. Once
+        # they are written its internal name is fixed, unless the table is
+        # created by this transaction and the copy gets the same update.
+        self.writer.wait()
+        if table.update is not None:
+            table.internal_name
+        current = self.inspector.get_table(oid=table.oid)
+        self.inspector.columns(current)
+        updated = copy.copy(table)
+        updated.columns = list(table.columns)
+        known = self._columns[(table.schema.name, table.name)]
+        for column in current.columns:
+            if column.name not in known:
+                column = Column(updated, column.ctid, column.name, column.number, column.type, column.length)
+                updated.columns.append(column)
+                self.change(add_column, column)
+        self.add(updated)
+        # Columns the catalog does not know are not looked for again
+        self._columns[(table.schema.name, table.name)].update(values)
+        return updated
+
+    def identity(self, table):
+        """
+        The key columns of table and whether its replica identity is full,
+        then old versions come with all their columns
+        """
+        identity = self._keys.get(table.oid)
+        if identity is None:
+            identity = self._keys[table.oid] = (self.inspector.key_columns(table),
+                                                self.inspector.replica_identity(table) == 'f')
+        return identity
+
+    def key(self, table, values):
+        """
+        The identity of a row as a tuple of (name, value) pairs, all columns
+        for tables with full replica identity but no key, or None if the
+        values do not identify the row
+        """
+        names, full = self.identity(table)
+        if not values:
+            return None
+        if names and all(name in values for name in names):
+            return tuple((name, values[name]) for name in names)
+        if full:
+            return tuple((name, values[name]) for name in sorted(values))
+        return None
+
+    def origin(self, table, old, new):
+        """
+        The identity of the row an update or delete changes. Decoding leaves
+        out the old key of an update that did not change it, the new
+        version then has it. Without a key nothing else in the new version
+        says which row it was.
+        """
+        if old:
+            return self.key(table, old)
+        names, full = self.identity(table)
+        if names:
+            return self.key(table, new)
+        return None
+
+    def unidentified(self, table):
+        self.stats.count('changes_unidentified')
+        if table.oid not in self._unidentified:
+            self._unidentified.add(table.oid)
+            self.logger.warning('cannot tell which rows of {} are updated and deleted, those changes are not '
+                                'replayed; give it a primary key or REPLICA IDENTITY FULL'.format(table.long_name))
+
+    def key_columns(self, table, key):
+        columns = dict((column.name, column) for column in table.columns)
+        return [(columns[name], value) for name, value in key if name in columns]
+
+
+class FanOut(object):
+    """
+    Replays one slave log into a history database per slave database. The
+    log is read and classified once, heap records go to the Worker of their
+    database and every other record is handled here. A commit is applied by
+    the workers that got records for it, each on a thread of its own, and
+    the slave is resumed once all of them are done reading from it.
+    """
+
+    def __init__(self, infile, parser, workers, stats=None):
+        self.infile = infile
+        self.parser = parser
+        self.workers = workers
+        self.stats = stats or Stats()
+        self._routes = {}
+        self._pending = []
+        self._commited = False
+        self._timestamp = None
+        self._lsn = None
+        self._paused_at = None
+        self._lines = 0
+
+    def consume(self):
+        line = self.infile.readline()
+        record = self.parser.line(line)
+        self._lines += 1
+        if not record:
+            return
+
+        if record[0] == 'redo':
+            work = record[1]
+            commit = self.parser.commit(work)
+            if commit:
+                if self._routes:
+                    self._commited = True
+                    self._timestamp = commit[1]
+                    self._lsn = record[2]
+            elif self._commited:
+                self.commit(self._timestamp, self._lsn)
+                self._commited = False
+                self._timestamp = None
+                self._lsn = None
+            worker = self._routes.get(self.parser.database(work))
+            if worker:
+                if worker not in self._pending:
+                    self._pending.append(worker)
+                worker.collect(work)
+        elif record[0] == 'paused':
+            if self._routes:
+                self.workers[0].inspector.resume()
+                if self._paused_at:
+                    self.stats.observe('pause', time.time() - self._paused_at)
+                    self._paused_at = None
+        elif record[0] == 'connect':
+            # Every database is set up before the slave moves on
+            for worker in self.workers:
+                worker.connect(self._timestamp)
+            self._routes = dict((str(worker.inspector.db_oid), worker) for worker in self.workers)
+            self._pending = []
+            self.workers[0].inspector.resume()
+            self._timestamp = None
+        elif record[0] == 'lastup':
+            self._timestamp = record[1]
+
+    def commit(self, timestamp, lsn):
+        self._paused_at = time.time()
+        self.stats.count('lines', self._lines)
+        self._lines = 0
+        workers = self._pending
+        self._pending = []
+        if len(workers) == 1:
+            workers[0].commit(timestamp, lsn)
+            return
 
+        errors = []
 
-def connect(slave, history):
-    slavecon = psycopg2.connect(**slave)
-    histcon = psycopg2.connect(**history)
-    slavecon.autocommit = True
-    histcon.autocommit = True
-    return slavecon, histcon
+        def commit(worker):
+            try:
+                worker.commit(timestamp, lsn)
+            except Exception as e:
+                errors.append(e)
 
-def connect_callback(timestamp):
+        threads = [threading.Thread(target=commit, args=(worker,)) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+# Changes that take more than one HistoryPopulator call or depend on the
+# history database, run with the populator as the first argument
+
+def drop_table(populator, ctid):
+    table = populator.get_table(ctid)
+    if table:
+        populator.delete_all(table)
+    populator.remove_table(ctid)
+
+
+def close_table(populator, table):
+    for column in table.columns:
+        populator.remove_column(column.ctid)
+    populator.remove_table(table.ctid)
+
+
+def add_column(populator, column):
+    column.table.update = populator.update_id
+    populator.add_column(column)
+    populator.add_data_column(column)
+
+
+def update_column(populator, column, ctid):
+    old_column = populator.get_column(ctid)
+    if column and old_column:
+        column.table.update = populator.update_id
+        column = Column(column.table, column.ctid, column.name, column.number, column.type,
+                column.length, internal_name=old_column.internal_name)
+        populator.add_column(column)
+    populator.remove_column(ctid)
+
+
+def arguments():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--slave-host', help='Hostname or IP of the slave database')
@@ -207,50 +1319,451 @@ def connect_callback(timestamp):
     parser.add_argument('--history-password', help='Password for the history database')
     parser.add_argument('--history-database', help='Name of the history database')
 
+    parser.add_argument('--database', action='append', dest='databases', metavar='SLAVE[=HISTORY]',
+            help='Replay this slave database into the history database of the same name or the given '
+                 'one instead of --slave-database, may be given several times to replay several databases '
+                 'from one log')
+
+    parser.add_argument('--bootstrap', choices=('copy', 'insert'), default='copy',
+            help='Copy the initial table data with COPY (default) or row by row INSERTs')
+    parser.add_argument('--apply', choices=('batch', 'row'), default='batch',
+            help='Write the changes of each replayed commit in batches (default) or row by row')
+
+    parser.add_argument('--bootstrap-workers', type=int, default=1,
+            help='Number of tables to fill at the same time during the initial copy')
+
+    parser.add_argument('--pipeline-depth', type=int, default=4,
+            help='Number of replayed commits that may wait for their history writes, 0 writes them inline')
+    parser.add_argument('--apply-shards', type=int, default=1,
+            help='Number of history connections writing the changes to different tables at the same time, '
+                 'an update is only complete once all of them have written it')
+    parser.add_argument('--fetch-connections', type=int, default=0,
+            help='Number of extra slave connections fetching the tuples of different tables at the same time, '
+                 '0 fetches them one table after the other')
+
+    parser.add_argument('--spill-threshold', type=int, default=100000,
+            help='Number of redo records of a transaction kept in memory, the records of larger ones go to a '
+                 'temporary file and are applied this many at a time, 0 keeps them all in memory')
+
+    parser.add_argument('--bulk-threshold', type=int, default=10000,
+            help='Number of records for one table in a transaction from which, if they are for at least a '
+                 'quarter of its rows, the table is diffed against all its rows on the slave instead of replayed '
+                 'tuple by tuple, 0 never does')
+
+    parser.add_argument('--storage', choices=('full', 'delta'), default='full',
+            help='Store every version whole (default) or only the columns an update changed')
+    parser.add_argument('--delta-cache', type=int, default=100000,
+            help='Number of recently written rows whose column hashes are kept for delta storage')
+
+    parser.add_argument('--partition-size', type=int,
+            help='Partition new history tables by ranges of this many updates (needs PostgreSQL 11 or later)')
+
+    parser.add_argument('--indexes', choices=('check', 'rebuild', 'skip'), default='check',
+            help='On startup create missing history indexes and rebuild invalid ones (default), '
+                 'rebuild all of them or leave them alone')
+
+    parser.add_argument('--input', default='-',
+            help='Slave log to replay: a file, named pipe or - for stdin (default)')
+    parser.add_argument('--input-format', choices=('log', 'test_decoding', 'wal2json'), default='log',
+            help='What the input is: the log of the patched slave (default) or logical decoding output of '
+                 'the test_decoding or wal2json (format 1) plugin, written by pg_recvlogical with '
+                 'include-timestamp on. The slave options then name the database decoded.')
+    parser.add_argument('--slot',
+            help='Logical replication slot the input is decoded from. An empty history database is bootstrapped '
+                 'by creating the slot and copying the snapshot it starts from, start pg_recvlogical on the '
+                 'slot once it exists (it retries until then).')
+
+    parser.add_argument('--stats-file',
+            help='Write replay counters and latencies to this file in the Prometheus text format')
+    parser.add_argument('--stats-interval', type=int, default=10,
+            help='Seconds between writes of the stats file')
+    parser.add_argument('--stats-port', type=int,
+            help='Serve the stats over HTTP on this port on localhost')
+    parser.add_argument('--profile',
+            help='Start and stop profiling the replay loop on SIGUSR1, dumping the profile to this file')
+
     args = parser.parse_args()
+    if args.apply_shards < 1:
+        parser.error('--apply-shards needs at least one connection')
+    if args.input_format != 'log':
+        if args.storage == 'delta':
+            parser.error('delta storage needs the slave log as input')
+        if args.databases and len(args.databases) > 1:
+            parser.error('logical decoding output is for a single database')
+    elif args.slot:
+        parser.error('--slot is for logical decoding input')
+    return args
+
+
+class Replayer(object):
+    """
+    State that lives as long as the process: the parsed configuration, the
+    loggers and the slave and history connections. connect() is the Worker's
+    connect callback, run every time the slave accepts connections, and
+    writer() its writer callback.
+    """
+
+    def __init__(self, args, slave_database=None, history_database=None, stats=None):
+        self.args = args
+
+        slave = {
+            'host': args.slave_host,
+            'port': args.slave_port,
+            'user': args.slave_user,
+            'password': args.slave_password,
+            'database': slave_database or args.slave_database
+        }
+
+        history = {
+            'host': args.history_host,
+            'port': args.history_port,
+            'user': args.history_user,
+            'password': args.history_password,
+            'database': history_database or args.history_database
+        }
+
+        pool_logger = get_logger('pool')
+        self.inspector_logger = get_logger('inspector')
+        self.populator_logger = get_logger('populator')
+
+        size = max(args.bootstrap_workers, 1)
+        self.slave = ConnectionPool(slave, size=size, logger=pool_logger)
+        self.history = ConnectionPool(history, size=size, logger=pool_logger)
+        self.fetcher = None
+        if args.fetch_connections > 0:
+            self.fetcher = AsyncFetcher(slave, size=args.fetch_connections, logger=pool_logger)
+        self.populator = None
+        self.shards = []
+        self.indexes_checked = False
+        self.stats = stats or Stats()
+
+    def connect(self, timestamp):
+        args = self.args
+        slavecon = self.slave.get()
+        histcon = self.history.get()
+        if self.fetcher:
+            # Its connections died with the slave, run() opens new ones
+            self.fetcher.close()
+
+        inspector = SlaveInspector(slavecon, logger=self.inspector_logger, fetcher=self.fetcher)
+        if self.populator is None or self.populator.con is not histcon:
+            self.populator = HistoryPopulator(histcon, logger=self.populator_logger,
+                    batch=args.apply == 'batch', partition_size=args.partition_size, stats=self.stats,
+                    delta=args.storage == 'delta')
+        populator = self.populator
+
+        populator.create_tables()
+        populator.rollback_incomplete()
+        if not self.indexes_checked:
+            if populator.delta:
+                populator.add_delta_columns()
+            if args.indexes != 'skip':
+                populator.check_indexes(rebuild=args.indexes == 'rebuild')
+            self.indexes_checked = True
+        checkpoint = populator.checkpoint()
+        if checkpoint and args.input_format == 'test_decoding':
+            # Nothing tells which of the transactions in the input were
+            # replayed before
+            raise RuntimeError('test_decoding output has no LSNs to resume from, replay wal2json output '
+                               'or bootstrap an empty history database')
+        if checkpoint:
+            self.resume(inspector, populator, timestamp or checkpoint[1])
+        else:
+            self.bootstrap(inspector, populator, timestamp)
+
+        return slavecon, inspector, populator
+
+    def writer(self, populator, depth, logger=None, stats=None):
+        if self.args.apply_shards < 2:
+            return HistoryWriter(populator, depth, logger=logger, stats=stats)
+        for shard in self.shards:
+            self.history.release(shard.con)
+        self.shards = [HistoryPopulator(self.history.acquire(), logger=self.populator_logger,
+                               batch=self.args.apply == 'batch', stats=self.stats,
+                               delta=self.args.storage == 'delta')
+                       for i in range(self.args.apply_shards)]
+        return ShardedWriter(populator, self.shards, depth, logger=logger, stats=stats)
+
+    def bootstrap(self, inspector, populator, timestamp):
+        """
+        Copies the whole slave database into an empty history database. The
+        update stays incomplete until every table is filled, so a bootstrap
+        that is stopped is rolled back and started over.
+
+        For logical decoding input the copy is the snapshot the new slot
+        starts decoding from and the slot's consistent point is the update's
+        LSN, commits up to it are skipped.
+        """
+        location = inspector.replay_location()
+        replication = snapshot = None
+        if self.args.input_format != 'log':
+            if not self.args.slot:
+                raise RuntimeError('bootstrapping from logical decoding needs --slot')
+            replication, location, snapshot = self.create_slot(inspector.con)
+
+        try:
+            populator.update(timestamp, location, complete=False)
+            tables = []
+            for schema in inspector.schemas():
+                populator.add_schema(schema)
+                for table in inspector.tables(schema):
+                    inspector.columns(table)
+                    populator.add_table(table)
+                    populator.create_table(table)
+                    tables.append(table)
+
+            self.fill(tables, inspector.con, populator, snapshot)
+        finally:
+            if replication:
+                with inspector.con.cursor() as curs:
+                    curs.execute('COMMIT')
+                replication.close()
+        populator.complete_updates([populator.update_id])
+
+    def create_slot(self, slavecon):
+        """
+        Creates the logical replication slot and starts a transaction on
+        slavecon with the snapshot it exported, returns the replication
+        connection, the slot's consistent point and the snapshot name. The
+        snapshot is only valid until the replication connection is closed.
+        """
+        replication = psycopg2.connect(replication='database', **self.slave.coninfo)
+        replication.autocommit = True
+        with replication.cursor() as curs:
+            query = 'CREATE_REPLICATION_SLOT {} LOGICAL {}'.format(self.args.slot, self.args.input_format)
+            if replication.server_version >= 100000:
+                query += ' EXPORT_SNAPSHOT'
+            curs.execute(query)
+            _, location, snapshot, _ = curs.fetchone()
+        self.populator_logger.info('created slot {} at {} with snapshot {}'.format(
+            self.args.slot, location, snapshot))
+        with slavecon.cursor() as curs:
+            curs.execute('BEGIN ISOLATION LEVEL REPEATABLE READ')
+            curs.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+        return replication, location, snapshot
+
+    def resume(self, inspector, populator, timestamp):
+        """
+        Continues from the last replayed commit. Commits up to it are skipped
+        by the Worker. If the slave has already replayed past it we missed
+        some of the log, so the tables whose catalog rows changed are brought
+        up to date and the rest keep their history.
+        """
+        history = HistoryInspector(populator.con, logger=self.inspector_logger)
+        old_schemas = dict((schema.oid, schema) for schema in history.schemas())
+        old_tables = {}
+        for schema in old_schemas.itervalues():
+            for table in history.tables(schema):
+                history.columns(table)
+                old_tables[table.oid] = table
+
+        location = inspector.replay_location()
+        if not location or not populator.lsn or parse_lsn(location) <= parse_lsn(populator.lsn):
+            # The slave will replay what we have seen already, until then the
+            # history catalog is the newer one
+            self.populator_logger.info('resuming from {}'.format(populator.lsn))
+            for schema in inspector.schemas():
+                list(inspector.tables(schema))
+            for filenode, table in inspector.tabledict.items():
+                del inspector.tabledict[filenode]
+                old = old_tables.get(table.oid)
+                if old:
+                    old.con = table.con
+                    inspector.tabledict[filenode] = old
+            return
+
+        self.populator_logger.warning('slave is at {}, past the last replayed commit at {}'.format(
+            location, populator.lsn))
+        changes = []
+        tables = []
+        for schema in inspector.schemas():
+            old = old_schemas.pop(schema.oid, None)
+            if not old or (old.ctid, old.name) != (schema.ctid, schema.name):
+                if old:
+                    changes.append((HistoryPopulator.remove_schema, (old.ctid,)))
+                changes.append((HistoryPopulator.add_schema, (schema,)))
+
+            for table in inspector.tables(schema):
+                inspector.columns(table)
+                old = old_tables.pop(table.oid, None)
+                if old and old.structure == table.structure:
+                    table.set_internal_names(old)
+                    if self.catalog_rows(old) != self.catalog_rows(table):
+                        changes.append((close_table, (old,)))
+                        changes.append((HistoryPopulator.add_table, (table,)))
+                    continue
+
+                if old:
+                    changes.append((HistoryPopulator.delete_all, (old,)))
+                    changes.append((close_table, (old,)))
+                changes.append((HistoryPopulator.add_table, (table,)))
+                changes.append((HistoryPopulator.create_table, (table,)))
+                tables.append(table)
+
+        for old in old_tables.itervalues():
+            changes.append((HistoryPopulator.delete_all, (old,)))
+            changes.append((close_table, (old,)))
+        for old in old_schemas.itervalues():
+            changes.append((HistoryPopulator.remove_schema, (old.ctid,)))
+
+        if not changes:
+            return
+
+        self.populator_logger.info('reconciling {} catalog changes, refilling {} tables'.format(
+            len(changes), len(tables)))
+        # Incomplete until the new tables are filled, like a bootstrap
+        populator.begin()
+        populator.update(timestamp, location, complete=False)
+        for function, args in changes:
+            function(populator, *args)
+        populator.commit()
+
+        self.fill(tables, inspector.con, populator)
+        populator.complete_updates([populator.update_id])
 
-    slave = {
-        'host': args.slave_host,
-        'port': args.slave_port,
-        'user': args.slave_user,
-        'password': args.slave_password,
-        'database': args.slave_database
-    }
-
-    history = {
-        'host': args.history_host,
-        'port': args.history_port,
-        'user': args.history_user,
-        'password': args.history_password,
-        'database': args.history_database
-    }
-
-
-    slavecon, histcon = connect(slave, history)
-
-    inspector_logger = get_logger('inspector')
-    populator_logger = get_logger('populator')
-
-    inspector = SlaveInspector(slavecon, logger=inspector_logger)
-    populator = HistoryPopulator(histcon, logger=populator_logger)
-
-    populator.create_tables()
-    populator.update(timestamp)
-    for schema in inspector.schemas():
-        populator.add_schema(schema)
-        for table in inspector.tables(schema):
-            inspector.columns(table)
-            populator.add_table(table)
-            populator.create_table(table)
+    def catalog_rows(self, table):
+        return [(table.ctid, table.name)] + [(column.ctid, column.name) for column in table.columns]
+
+    def fill(self, tables, slavecon, populator, snapshot=None):
+        if self.args.bootstrap_workers > 1:
+            self.fill_tables(tables, slavecon, populator.update_id, snapshot)
+        else:
+            for table in tables:
+                self.fill_table(populator, table)
+
+    def fill_table(self, populator, table):
+        if self.args.bootstrap == 'copy':
+            populator.copy_table(table)
+        else:
             populator.fill_table(table)
 
-    return slavecon, inspector, populator
+    def fill_tables(self, tables, slavecon, update_id, snapshot=None):
+        """
+        Fills the tables with a pool of workers, each with its own slave and
+        history connection. The slave connections all import the given
+        snapshot, or one exported from slavecon, so every table is copied as
+        of the same point. A standby cannot export snapshots before 10 and
+        needs none, its replay is paused while the tables are filled.
+        """
+        workers = self.args.bootstrap_workers
+
+        exported = False
+        if snapshot is None:
+            with slavecon.cursor() as curs:
+                curs.execute('SELECT pg_is_in_recovery()')
+                exported = not curs.fetchone()[0]
+        if exported:
+            with slavecon.cursor() as curs:
+                curs.execute('BEGIN ISOLATION LEVEL REPEATABLE READ')
+                curs.execute('SELECT pg_export_snapshot()')
+                snapshot, = curs.fetchone()
+        self.populator_logger.info('filling {} tables with {} workers{}'.format(
+            len(tables), workers, ' from snapshot {}'.format(snapshot) if snapshot else ''))
+
+        queue = Queue.Queue()
+        for table in tables:
+            queue.put(table)
+        errors = []
+
+        def work():
+            workercon = histcon = None
+            try:
+                workercon = self.slave.acquire()
+                histcon = self.history.acquire()
+                with workercon.cursor() as curs:
+                    curs.execute('BEGIN ISOLATION LEVEL REPEATABLE READ')
+                    if snapshot:
+                        curs.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+                populator = HistoryPopulator(histcon, logger=self.populator_logger)
+                populator.update_id = update_id
+                while not errors:
+                    try:
+                        table = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    table = copy.copy(table)
+                    table.con = workercon
+                    self.fill_table(populator, table)
+                with workercon.cursor() as curs:
+                    curs.execute('COMMIT')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if workercon:
+                    self.slave.release(workercon)
+                if histcon:
+                    self.history.release(histcon)
+
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if exported:
+            with slavecon.cursor() as curs:
+                curs.execute('COMMIT')
+
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        for shard in self.shards:
+            self.history.discard(shard.con)
+        self.shards = []
+        self.slave.close()
+        self.history.close()
+        if self.fetcher:
+            self.fetcher.close()
 
 
 def main():
-    worker = Worker(sys.stdin, RegExer(), connect_callback)
-    while True:
-        worker.consume()
+    args = arguments()
+    if args.input == '-':
+        infile = sys.stdin
+    else:
+        infile = open(args.input)
+
+    stats = Stats()
+    if args.databases:
+        replayers = []
+        for database in args.databases:
+            slave_database, _, history_database = database.partition('=')
+            replayers.append(Replayer(args, slave_database, history_database or slave_database, stats))
+    else:
+        replayers = [Replayer(args, stats=stats)]
+    reporter = None
+    if args.stats_file or args.stats_port:
+        reporter = StatsReporter(stats, args.stats_file, args.stats_port,
+                interval=args.stats_interval, logger=get_logger('stats'))
+    if args.profile:
+        Profiler(args.profile, logger=get_logger('profiler'))
+
+    reader = LogReader(infile, logger=get_logger('reader'))
+    if args.input_format != 'log':
+        parser = TestDecodingParser() if args.input_format == 'test_decoding' else Wal2JsonParser()
+        worker = DecodingWorker(reader, parser, replayers[0].connect, depth=args.pipeline_depth, stats=stats,
+                logger=get_logger('decoding'), writer_callback=replayers[0].writer)
+    else:
+        parser = LogParser()
+        workers = [Worker(reader, parser, replayer.connect, depth=args.pipeline_depth, stats=stats,
+                          delta=args.storage == 'delta', delta_cache=args.delta_cache,
+                          writer_callback=replayer.writer, spill_threshold=args.spill_threshold,
+                          bulk_threshold=args.bulk_threshold)
+                   for replayer in replayers]
+        if len(workers) > 1:
+            worker = FanOut(reader, parser, workers, stats=stats)
+        else:
+            worker = workers[0]
+    try:
+        while not reader.finished:
+            worker.consume()
+        worker.close()
+    finally:
+        for replayer in replayers:
+            replayer.close()
+        if reporter:
+            reporter.close()
 
 
 if __name__ == "__main__":
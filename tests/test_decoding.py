@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from history import TestDecodingParser, Wal2JsonParser, DecodingWorker
+from utils.dbobjects import Schema, Table
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def transactions(parser, name):
+    with open(os.path.join(FIXTURES, name)) as infile:
+        return [transaction for transaction in (parser.line(line) for line in infile) if transaction]
+
+
+class Inspector(object):
+    """
+    The part of SlaveInspector DecodingWorker.coalesce uses, for the
+    tables of the fixtures
+    """
+    keys = {'keyed': ['id'], 'Quoted Table': ['Key']}
+    identities = {'full': 'f'}
+
+    def key_columns(self, table):
+        return self.keys.get(table.name, [])
+
+    def replica_identity(self, table):
+        return self.identities.get(table.name, 'd')
+
+
+def worker():
+    worker = DecodingWorker(None, None, None)
+    worker.inspector = Inspector()
+    schema = Schema('(0,1)', 2200, 'public')
+    columns = {'keyed': ('id', 'data', 'big'), 'keyless': ('a', 'b'), 'full': ('a', 'b'), 'Quoted Table': ('Key',)}
+    for oid, (name, names) in enumerate(sorted(columns.items()), 16384):
+        table = Table(schema, '(0,{})'.format(oid), oid, name)
+        for number, column in enumerate(names, 1):
+            table.add_column('(1,{})'.format(number), column, number, 'text', -1)
+        worker.add(table)
+    return worker
+
+
+class TestDecodingParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transactions = transactions(TestDecodingParser(), 'test_decoding.txt')
+
+    def test_transactions(self):
+        self.assertEqual([(timestamp, lsn) for timestamp, lsn, changes in self.transactions], [
+            ('2014-03-01 10:00:00.123456', None),
+            ('2014-03-01 10:00:01.5', None),
+            ('2014-03-01 10:00:02', None),
+            ('2014-03-01 10:00:03', None),
+            ('2014-03-01 10:00:04', None),
+        ])
+        self.assertEqual(self.transactions[3][2], [])
+
+    def test_values(self):
+        changes = self.transactions[0][2]
+        # Unchanged TOAST values are left out
+        self.assertEqual(changes[1], ('update', 'public', 'keyed', {'id': '1', 'data': 'uno'}, None))
+        self.assertEqual(changes[2], ('insert', 'public', 'keyed', {'id': '2', 'data': "it's\ntwo lines", 'big': None},
+                                      None))
+
+    def test_old_key(self):
+        self.assertEqual(self.transactions[1][2], [
+            ('update', 'public', 'keyed', {'id': '20', 'data': 'twenty', 'big': None}, {'id': '2'}),
+            ('delete', 'public', 'keyed', None, {'id': '3'}),
+        ])
+
+    def test_without_key(self):
+        changes = self.transactions[2][2]
+        self.assertEqual(changes[1], ('update', 'public', 'keyless', {'a': '1', 'b': 'y'}, None))
+        self.assertEqual(changes[2], ('delete', 'public', 'keyless', None, None))
+        self.assertEqual(changes[3], ('update', 'public', 'full', {'a': '1', 'b': 'y'}, {'a': '1', 'b': 'x'}))
+        self.assertEqual(changes[4], ('delete', 'public', 'full', None, {'a': '2', 'b': 'z'}))
+
+    def test_quoted_names(self):
+        self.assertEqual(self.transactions[4][2], [
+            ('truncate', 'public', 'Quoted Table', None, None),
+            ('insert', 'public', 'Quoted Table', {'Key': '7'}, None),
+        ])
+
+
+class Wal2JsonParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transactions = transactions(Wal2JsonParser(), 'wal2json.txt')
+
+    def test_transactions(self):
+        self.assertEqual([(timestamp, lsn, len(changes)) for timestamp, lsn, changes in self.transactions], [
+            ('2014-03-01 10:00:00.123456', '0/16B2F78', 3),
+            ('2014-03-01 10:00:01.5', '0/16B3058', 2),
+            ('2014-03-01 10:00:02', '0/16B3150', 5),
+            ('2014-03-01 10:00:03', '0/16B31C8', 0),
+        ])
+
+    def test_changes(self):
+        self.assertEqual(self.transactions[1][2], [
+            ('update', 'public', 'keyed', {'id': 20, 'data': 'twenty', 'big': None}, {'id': 2}),
+            ('delete', 'public', 'keyed', None, {'id': 3}),
+        ])
+        changes = self.transactions[2][2]
+        self.assertEqual(changes[1], ('update', 'public', 'keyless', {'a': 1, 'b': 'y'}, None))
+        self.assertEqual(changes[2], ('delete', 'public', 'keyless', None, None))
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def coalesce(self, name, number):
+        self.worker = worker()
+        changes = transactions(TestDecodingParser() if name == 'test_decoding.txt' else Wal2JsonParser(),
+                               name)[number][2]
+        return [(table.name, origin, values) for table, origin, values in self.worker.coalesce(changes)]
+
+    def test_chain(self):
+        # An insert and an update of it are one new version
+        self.assertEqual(self.coalesce('test_decoding.txt', 0), [
+            ('keyed', None, {'id': '1', 'data': 'uno', 'big': 'B1'}),
+            ('keyed', None, {'id': '2', 'data': "it's\ntwo lines", 'big': None}),
+        ])
+
+    def test_old_key(self):
+        for name in ('test_decoding.txt', 'wal2json.txt'):
+            chains = self.coalesce(name, 1)
+            self.assertEqual([(table, origin) for table, origin, values in chains], [
+                ('keyed', (('id', chains[0][1][0][1]),)),
+                ('keyed', (('id', chains[1][1][0][1]),)),
+            ])
+            self.assertEqual([str(origin[0][1]) for table, origin, values in chains], ['2', '3'])
+            self.assertEqual(chains[1][2], None)
+
+    def test_without_key(self):
+        for name in ('test_decoding.txt', 'wal2json.txt'):
+            chains = self.coalesce(name, 2)
+            # The update and delete of the row without a key are skipped,
+            # not guessed from the new values
+            self.assertEqual([(table, origin) for table, origin, values in chains if table == 'keyless'],
+                             [('keyless', None)])
+            self.assertEqual(self.worker.stats.counters['changes_unidentified'], 2)
+            # Full replica identity identifies rows by all their old values
+            full = [(origin, values) for table, origin, values in chains if table == 'full']
+            self.assertEqual([[(column, str(value)) for column, value in origin] for origin, values in full],
+                             [[('a', '1'), ('b', 'x')], [('a', '2'), ('b', 'z')]])
+            self.assertEqual([values and values['b'] for origin, values in full], ['y', None])
+
+    def test_truncate(self):
+        chains = self.coalesce('test_decoding.txt', 4)
+        self.assertEqual([(table, origin) for table, origin, values in chains], [
+            ('Quoted Table', DecodingWorker.TRUNCATE),
+            ('Quoted Table', None),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
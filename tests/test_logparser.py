@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from history import LogParser, Worker
+
+
+def redo(work):
+    return 'LOG:  REDO @ 0/1D0; LSN 0/1D8: prev 0/0; xid 700; len 3: {}\n'.format(work)
+
+
+class LogParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = LogParser()
+
+    def test_heap(self):
+        record = self.parser.line(redo('Heap - hot_update: rel 1663/5/16385; tid 0/3 xmax 700 ; new tid 0/9 xmax 0'))
+        self.assertEqual(record, ('redo', 'Heap - hot_update: rel 1663/5/16385; tid 0/3 xmax 700 ; new tid 0/9 xmax 0',
+                                  '0/1D8'))
+        self.assertEqual(self.parser.heap(record[1], '5'), ('update', 16385, 0, 3, 0, 9))
+        self.assertEqual(self.parser.heap(record[1], '6'), None)
+
+    def test_multi_insert(self):
+        work = 'Heap2 - multi-insert: rel 1663/5/16385; blk 7; 12 tuples'
+        self.assertEqual(self.parser.database(work), '5')
+        self.assertEqual(self.parser.heap(work, '5'), ('multi_insert', 16385, 7, 12, False, 0))
+        self.assertEqual(self.parser.heap(work, '6'), None)
+        work = 'Heap2 - multi-insert (init): rel 1663/5/16385; blk 0; 3 tuples'
+        self.assertEqual(self.parser.heap(work, '5'), ('multi_insert', 16385, 0, 3, True, 0))
+        # Other Heap2 records are of no interest
+        work = 'Heap2 - clean: rel 1663/5/16385; blk 0 remxid 700'
+        self.assertEqual(self.parser.database(work), None)
+        self.assertEqual(self.parser.heap(work, '5'), None)
+
+
+class RecordsTest(unittest.TestCase):
+
+    def test_multi_insert(self):
+        worker = Worker(None, LogParser(), None)
+        worker._db_node = '5'
+        records = worker.records([
+            'Heap - insert: rel 1663/5/16385; tid 0/1',
+            'Heap2 - multi-insert (init): rel 1663/5/16385; blk 1; 3 tuples',
+            'Heap2 - multi-insert: rel 1663/5/16390; blk 4; 20 tuples',
+            'Transaction - commit: 2014-03-01 10:00:00.123',
+        ])
+        # Tuples on a new page are at the first offsets, the others are
+        # left to the diff of their table
+        self.assertEqual(records, [
+            ('insert', 16385, 0, 1, 0, 0),
+            ('insert', 16385, 1, 1, 0, 0),
+            ('insert', 16385, 1, 2, 0, 0),
+            ('insert', 16385, 1, 3, 0, 0),
+        ])
+        self.assertEqual(worker._copied, set([16390]))
+        self.assertEqual(worker._counts, {16390: 20})
+
+
+if __name__ == '__main__':
+    unittest.main()
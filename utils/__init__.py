@@ -5,17 +5,27 @@ import logging
 
 from inspector import SlaveInspector, HistoryInspector
 from populator import HistoryPopulator, ClonePopulator
+from logreader import LogReader
+from writer import HistoryWriter, ShardedWriter
+from pool import ConnectionPool
+from fetcher import AsyncFetcher
+from spill import SpillFile
+from compactor import HistoryCompactor
+from stats import Stats, StatsReporter, Profiler
 
 
 __all__ = ('SlaveInspector', 'HistoryInspector', 'HistoryPopulator',
-        'ClonePopulator', 'get_logger')
+        'ClonePopulator', 'LogReader', 'HistoryWriter', 'ShardedWriter', 'ConnectionPool',
+        'AsyncFetcher', 'SpillFile', 'HistoryCompactor', 'Stats', 'StatsReporter', 'Profiler', 'get_logger')
 
 
 def get_logger(name):
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
     formatter = logging.Formatter(logging.BASIC_FORMAT)
     handler = logging.StreamHandler(sys.stdout)
     handler.setFormatter(formatter)
-    logger = logging.getLogger(name)
     logger.addHandler(handler)
     logger.setLevel(logging.DEBUG)
     return logger
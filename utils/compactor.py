@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from populator import HistoryPopulator
+
+
+class HistoryCompactor(object):
+    """
+    Removes what no clone from the horizon update onwards can see: versions
+    stopped at or before it, data tables no open table uses, their catalog
+    rows and updates nothing refers to any more.
+
+    Every statement removes at most batch_size rows and commits on its own,
+    so compaction holds no long locks and can run next to the replayer,
+    which never touches closed versions. With archive the rows and tables
+    are moved to the marty_archive schema instead of being deleted.
+    """
+    archive_schema = 'marty_archive'
+    catalogs = ('marty_schemas', 'marty_tables', 'marty_columns')
+
+    def __init__(self, con, batch_size=10000, archive=False, logger=None):
+        self.con = con
+        self.batch_size = batch_size
+        self.archive = archive
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger()
+            self.logger.addHandler(logging.NullHandler())
+        self.removed = {}
+        self.dropped = {}
+        self.parents = {}
+        self.populator = HistoryPopulator(con, logger=self.logger)
+
+    def horizon(self, update=None, mastertime=None):
+        """
+        The update id to compact up to, the given update or the last one
+        replayed at mastertime. Never later than the last complete update.
+        """
+        with self.con.cursor() as curs:
+            curs.execute('SELECT max(id) FROM marty_updates WHERE complete')
+            last, = curs.fetchone()
+            if mastertime is not None:
+                curs.execute('SELECT max(id) FROM marty_updates WHERE complete AND mastertime <= %s',
+                        (mastertime,))
+                update, = curs.fetchone()
+        if update is None or last is None:
+            return None
+        return min(update, last)
+
+    def database_size(self):
+        with self.con.cursor() as curs:
+            curs.execute('SELECT pg_database_size(current_database())')
+            return curs.fetchone()[0]
+
+    def compact(self, horizon, vacuum=True):
+        """
+        Compacts everything up to the horizon update id, returns the number
+        of rows removed per table, the size of the dropped tables and the
+        bytes reclaimed in total
+        """
+        self.logger.info('compacting history up to update {}'.format(horizon))
+        self.removed = {}
+        self.dropped = {}
+        before = self.database_size()
+        if self.archive:
+            with self.con.cursor() as curs:
+                curs.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(self.archive_schema))
+
+        self.drop_partitions(horizon)
+        tables = self.drop_tables(horizon)
+        for table_name in tables:
+            self.remove_versions(table_name, self.version_condition(table_name, horizon), horizon)
+        for catalog in self.catalogs:
+            self.remove_versions(catalog, 'stop <= %s', horizon)
+        # Dropped tables leave their columns open
+        self.remove_versions('marty_columns',
+                'start <= %s AND table_oid NOT IN (SELECT oid FROM marty_tables)', horizon)
+        self.remove_updates(horizon)
+
+        if vacuum:
+            for table_name in tables + list(self.catalogs) + ['marty_updates']:
+                self.vacuum(table_name)
+        after = self.database_size()
+        self.logger.info('reclaimed {} bytes, removed {} rows and {} tables'.format(
+            before - after, sum(self.removed.values()), len(self.dropped)))
+        return self.removed, self.dropped, before - after
+
+    def version_condition(self, table_name, horizon):
+        """
+        Versions stopped by the horizon, except full versions delta versions
+        after it are based on
+        """
+        parent = self.parents.get(table_name, table_name)
+        with self.con.cursor() as curs:
+            delta = self.populator.has_column(curs, parent, 'data_changed')
+        if not delta:
+            return 'stop <= %s'
+        return """stop <= %s AND NOT EXISTS (
+            SELECT 1 FROM {parent} d
+            WHERE d.data_base_ctid = {table}.data_ctid AND d.data_base_start = {table}.start
+              AND (d.stop IS NULL OR d.stop > {horizon})
+        )""".format(parent=parent, table=table_name, horizon=int(horizon))
+
+    def drop_tables(self, horizon):
+        """
+        Drops the data tables only used by tables closed by the horizon,
+        returns the remaining ones, partitions instead of partitioned tables.
+        A table closed by a catalog update, like an added column, can still
+        be written to by the replayer, so tables with open versions stay.
+        """
+        remaining = []
+        with self.con.cursor() as curs:
+            curs.execute("""
+            SELECT internal_name FROM marty_tables
+            GROUP BY internal_name
+            HAVING bool_and(stop IS NOT NULL AND stop <= %s)
+            """, (horizon,))
+            closed = set(name for name, in curs.fetchall())
+
+            for table_name, partitioned in self.populator.data_tables(curs):
+                if table_name in closed and not self.has_open_versions(curs, table_name):
+                    self.drop_table(curs, table_name)
+                elif partitioned:
+                    curs.execute("""
+                    SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass
+                    """, (table_name,))
+                    for name, in curs.fetchall():
+                        self.parents[name] = table_name
+                        remaining.append(name)
+                else:
+                    remaining.append(table_name)
+        return remaining
+
+    def has_open_versions(self, curs, table_name):
+        curs.execute('SELECT 1 FROM {} WHERE stop IS NULL LIMIT 1'.format(table_name))
+        return curs.fetchone() is not None
+
+    def drop_partitions(self, horizon):
+        """
+        Detaches and drops partitions holding nothing visible after the
+        horizon, a lot cheaper than deleting their rows
+        """
+        with self.con.cursor() as curs:
+            for name in self.populator.detach_partitions(horizon):
+                self.drop_table(curs, name)
+
+    def drop_table(self, curs, table_name):
+        # A partitioned table has no storage of its own
+        curs.execute("""
+        SELECT sum(pg_total_relation_size(oid)) FROM pg_class
+        WHERE oid = %s::regclass OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)
+        """, (table_name, table_name))
+        size, = curs.fetchone()
+        if self.archive:
+            self.logger.info('archiving table {}, {} bytes'.format(table_name, size))
+            curs.execute("""
+            SELECT 1 FROM pg_class
+            WHERE relname = %s AND relnamespace = (SELECT oid FROM pg_namespace WHERE nspname = %s)
+            """, (table_name, self.archive_schema))
+            if curs.fetchone():
+                # Versions of it were archived before, add the rest to them
+                self.archive_table(table_name)
+                curs.execute('INSERT INTO {}.{} SELECT * FROM {}'.format(
+                    self.archive_schema, table_name, table_name))
+                curs.execute('DROP TABLE {}'.format(table_name))
+            else:
+                curs.execute('ALTER TABLE {} SET SCHEMA {}'.format(table_name, self.archive_schema))
+                self.drop_update_references(curs, '{}.{}'.format(self.archive_schema, table_name))
+        else:
+            self.logger.info('dropping table {}, {} bytes'.format(table_name, size))
+            curs.execute('DROP TABLE {}'.format(table_name))
+        self.dropped[table_name] = int(size)
+
+    def remove_versions(self, table_name, condition, horizon):
+        """
+        Deletes, or archives, the rows matching condition batch_size rows
+        at a time. One scan finds them all, a WITH HOLD cursor keeps their
+        ctids across the commits of the batches.
+        """
+        query = """
+        WITH removed AS (
+            DELETE FROM {table} WHERE ctid = ANY(%s::tid[]) AND {condition}
+            RETURNING *
+        )
+        """.format(table=table_name, condition=condition)
+        if self.archive:
+            query += 'INSERT INTO {}.{} SELECT * FROM removed'.format(self.archive_schema, table_name)
+        else:
+            query += 'SELECT count(*) FROM removed'
+
+        total = 0
+        with self.con.cursor() as curs, self.con.cursor('marty_compact', withhold=True) as versions:
+            versions.execute('SELECT ctid FROM {} WHERE {}'.format(table_name, condition), (horizon,))
+            while True:
+                ctids = [ctid for ctid, in versions.fetchmany(self.batch_size)]
+                if not ctids:
+                    break
+                if self.archive and not total:
+                    self.archive_table(table_name)
+                # The condition is checked again, it only matches closed
+                # versions but a vacuum can reuse a ctid
+                curs.execute(query, (ctids, horizon))
+                total += curs.rowcount if self.archive else curs.fetchone()[0]
+        if total:
+            self.logger.info('removed {} versions from {}'.format(total, table_name))
+            self.removed[table_name] = self.removed.get(table_name, 0) + total
+        return total
+
+    def archive_table(self, table_name):
+        """
+        Creates the archive copy of a table, adding the columns added to it
+        since the last compaction
+        """
+        with self.con.cursor() as curs:
+            curs.execute('CREATE TABLE IF NOT EXISTS {}.{} (LIKE {})'.format(
+                self.archive_schema, table_name, table_name))
+            curs.execute("""
+            SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+            FROM pg_attribute a
+            WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+              AND a.attname NOT IN (
+                SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass
+              )
+            ORDER BY a.attnum
+            """, (table_name, '{}.{}'.format(self.archive_schema, table_name)))
+            for column, type in curs.fetchall():
+                curs.execute('ALTER TABLE {}.{} ADD COLUMN {} {}'.format(
+                    self.archive_schema, table_name, column, type))
+
+    def remove_updates(self, horizon):
+        """
+        Deletes the updates before the horizon that no version starts or
+        stops at any more. The foreign keys to marty_updates stay, they
+        check every batch against concurrent writes.
+        """
+        with self.con.cursor() as curs:
+            references = ['SELECT start FROM {0} WHERE start < %(horizon)s'
+                          ' UNION SELECT stop FROM {0} WHERE stop < %(horizon)s'.format(table_name)
+                          for table_name, _ in self.populator.data_tables(curs)]
+            references.extend('SELECT start FROM {0} UNION SELECT stop FROM {0}'.format(catalog)
+                              for catalog in self.catalogs)
+            curs.execute(' UNION '.join(references), {'horizon': horizon})
+            referenced = set(update for update, in curs.fetchall())
+            curs.execute('SELECT id FROM marty_updates WHERE id < %s ORDER BY id', (horizon,))
+            unused = [update for update, in curs.fetchall() if update not in referenced]
+
+            for i in range(0, len(unused), self.batch_size):
+                batch = unused[i:i + self.batch_size]
+                if self.archive:
+                    self.archive_table('marty_updates')
+                    curs.execute("""
+                    WITH removed AS (DELETE FROM marty_updates WHERE id = ANY(%s) RETURNING *)
+                    INSERT INTO {}.marty_updates SELECT * FROM removed
+                    """.format(self.archive_schema), (batch,))
+                else:
+                    curs.execute('DELETE FROM marty_updates WHERE id = ANY(%s)', (batch,))
+        if unused:
+            self.logger.info('removed {} updates'.format(len(unused)))
+            self.removed['marty_updates'] = len(unused)
+        return len(unused)
+
+    def drop_update_references(self, curs, table_name):
+        """
+        Drops the foreign keys to marty_updates of an archived table, the
+        archive keeps its own copy of the updates it refers to
+        """
+        # Dropping it from a partitioned table drops it from the partitions
+        curs.execute("""
+        SELECT c.conrelid::regclass::text, quote_ident(c.conname) FROM pg_constraint c
+        JOIN pg_class t ON t.oid = c.conrelid
+        WHERE c.contype = 'f' AND c.confrelid = 'marty_updates'::regclass
+          AND (c.conrelid = %s::regclass OR c.conrelid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass))
+        ORDER BY t.relkind = 'p' DESC
+        """, (table_name, table_name))
+        for name, constraint in curs.fetchall():
+            curs.execute('ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}'.format(name, constraint))
+
+    def vacuum(self, table_name):
+        # Plain VACUUM only takes a lock that allows reads and writes
+        self.logger.info('vacuuming {}'.format(table_name))
+        with self.con.cursor() as curs:
+            curs.execute('VACUUM ANALYZE {}'.format(table_name))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import Queue
+
+
+class CopyPipe(object):
+    """
+    File-like object connecting a COPY ... TO STDOUT on one connection to a
+    COPY ... FROM STDIN on another. The producing side runs in its own thread
+    and at most `maxsize` chunks are held in memory between the two.
+    """
+
+    def __init__(self, maxsize=256):
+        self.queue = Queue.Queue(maxsize)
+        self.chunks = []
+        self.buffered = 0
+        self.error = None
+        self.finished = False
+        self.closed = False
+        self.thread = None
+
+    def produce(self, target, *args):
+        """
+        Runs target(pipe, *args) in a new thread, target is expected to write
+        the COPY data into the pipe
+        """
+        def run():
+            try:
+                target(self, *args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self._put(None)
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, data):
+        while not self.closed:
+            try:
+                self.queue.put(data, timeout=1)
+                return
+            except Queue.Full:
+                pass
+        if data is not None:
+            raise IOError('copy pipe is closed')
+
+    def write(self, data):
+        self._put(data)
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or self.buffered < size):
+            data = self.queue.get()
+            if data is None:
+                self.finished = True
+            else:
+                self.chunks.append(data)
+                self.buffered += len(data)
+
+        data = ''.join(self.chunks)
+        if size < 0 or len(data) <= size:
+            self.chunks = []
+        else:
+            self.chunks = [data[size:]]
+            data = data[:size]
+        self.buffered -= len(data)
+        return data
+
+    def close(self, raise_error=True):
+        """
+        Stops the producer, waits for it and raises its error if it failed.
+        Without raise_error the error is dropped, when the consumer failed
+        first it is only that the pipe was closed.
+        """
+        self.closed = True
+        if self.thread:
+            self.thread.join()
+        if self.error and raise_error:
+            raise self.error
@@ -22,6 +22,8 @@ class Table(object):
         self.con = con
         self._internal_name = internal_name
         self.update = None
+        # History tables with delta storage columns
+        self.delta = False
 
     def __repr__(self):
         return u'<Table {} ({})>'.format(self.name, self.oid)
@@ -47,12 +49,35 @@ class Table(object):
     def add_column(self, ctid, name, number, type, length, internal_name=None):
         self.columns.append(Column(self, ctid, name, number, type, length, internal_name=internal_name))
 
+    @property
+    def structure(self):
+        return [(column.name, column.number, column.type, column.length) for column in self.columns]
+
+    def set_internal_names(self, other):
+        """
+        Takes over the internal table and column names of other, the same
+        table as recorded in the history database
+        """
+        self._internal_name = other.internal_name
+        names = dict((column.name, column.internal_name) for column in other.columns)
+        for column in self.columns:
+            column._internal_name = names[column.name]
+
     def data(self):
         with self.con.cursor() as curs:
             curs.execute('SELECT ctid, * FROM {}'.format(self.long_name))
             for row in curs:
                 yield row
 
+    def copy_data(self, outfile, update):
+        """
+        Writes the table in COPY text format to outfile, with the ctid first
+        and the start and stop columns for the given update last
+        """
+        with self.con.cursor() as curs:
+            query = 'COPY (SELECT ctid, *, {}, NULL FROM {}) TO STDOUT'
+            curs.copy_expert(query.format(int(update), self.long_name), outfile)
+
 
 class Column(object):
 
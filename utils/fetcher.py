@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import select
+import logging
+
+import psycopg2
+import psycopg2.extensions
+
+
+class AsyncFetcher(object):
+    """
+    Runs independent read queries side by side on up to `size` connections
+    in psycopg2's asynchronous mode, waiting on all of them with select().
+    The slave is paused while a commit is read, so every connection sees
+    the same data.
+    """
+
+    def __init__(self, coninfo, size=4, logger=None):
+        self.coninfo = coninfo
+        self.size = size
+        self._connections = []
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger()
+            self.logger.addHandler(logging.NullHandler())
+
+    def connect(self):
+        self.logger.info('connecting to {} for concurrent fetches'.format(self.coninfo.get('database')))
+        # async is a keyword from Python 3.7 on
+        con = psycopg2.connect(**dict(self.coninfo, **{'async': True}))
+        self.wait(con)
+        return con
+
+    def wait(self, con):
+        while True:
+            state = con.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            elif state == psycopg2.extensions.POLL_READ:
+                select.select([con.fileno()], [], [])
+            elif state == psycopg2.extensions.POLL_WRITE:
+                select.select([], [con.fileno()], [])
+
+    def run(self, queries):
+        """
+        Runs a list of (query, args) pairs and returns the rows of each, in
+        order. A failed query discards every connection and raises.
+        """
+        queries = list(queries)
+        while len(self._connections) < min(self.size, len(queries)):
+            self._connections.append(self.connect())
+
+        results = [None] * len(queries)
+        pending = iter(enumerate(queries))
+        running = {}
+        try:
+            for con in self._connections:
+                if not self._start(con, pending, running):
+                    break
+            while running:
+                readers = []
+                writers = []
+                for con in running.keys():
+                    state = con.poll()
+                    if state == psycopg2.extensions.POLL_OK:
+                        i, curs = running.pop(con)
+                        results[i] = curs.fetchall()
+                        curs.close()
+                        self._start(con, pending, running)
+                    elif state == psycopg2.extensions.POLL_READ:
+                        readers.append(con.fileno())
+                    elif state == psycopg2.extensions.POLL_WRITE:
+                        writers.append(con.fileno())
+                if readers or writers:
+                    select.select(readers, writers, [])
+        except psycopg2.Error:
+            self.close()
+            raise
+        return results
+
+    def _start(self, con, pending, running):
+        for i, (query, args) in pending:
+            curs = con.cursor()
+            curs.execute(query, args)
+            running[con] = (i, curs)
+            return True
+        return False
+
+    def close(self):
+        for con in self._connections:
+            if not con.closed:
+                con.close()
+        self._connections = []
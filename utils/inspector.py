@@ -1,15 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import logging
+
 from dbobjects import Schema, Table, Column, StartColumn, StopColumn
 
 class SlaveInspector(object):
+    # Catalog rows are cached by ctid (and oid) as plain tuples, a fresh
+    # object is made for every lookup
+    _catalog_queries = {
+        'pg_namespace': 'SELECT pg_namespace.ctid, oid, nspname FROM pg_namespace WHERE {}',
+        'pg_class': """
+            SELECT pg_class.ctid, oid, relname, relnamespace, relkind
+            FROM pg_class
+            WHERE relkind = 'r' AND {}
+            """,
+        'pg_attribute': """
+            SELECT pg_attribute.ctid, attrelid, attname, attnum, typname, atttypmod
+            FROM pg_attribute
+            LEFT JOIN pg_type ON pg_attribute.atttypid = pg_type.oid
+            WHERE attisdropped = false AND attnum > 0 AND {}
+            """,
+    }
 
-    def __init__(self, con, logger=None):
+    def __init__(self, con, logger=None, fetcher=None):
         self.con = con
+        # An AsyncFetcher to run the tuple fetches of different tables with
+        self.fetcher = fetcher
         self.db_oid = self._get_db_oid()
         self.tabledict = {}
         self._system_tables = None
         self.pg_namespace = None
+        self._catalog = {
+            'pg_namespace': ({}, {}),
+            'pg_class': ({}, {}),
+            'pg_attribute': ({}, None),
+        }
         if logger:
             self.logger = logger
         else:
@@ -103,57 +128,144 @@ class SlaveInspector(object):
                     self._system_tables[filenode] = table
         return self._system_tables
 
-    def get_schema(self, ctid=None, oid=None):
-        query = 'SELECT ctid, oid, nspname FROM pg_namespace '
-        if oid:
-            query += 'WHERE oid = %s'
-            values = (oid,)
-        else:
-            query += 'WHERE ctid = %s'
-            values = (ctid,)
+    def invalidate(self, catalog, ctids):
+        """
+        Forgets the cached pg_namespace, pg_class or pg_attribute rows at the
+        given ctids. Called for every catalog tuple the WAL touches, old and
+        new, before it is looked at.
+        """
+        by_ctid, by_oid = self._catalog[catalog]
+        for ctid in ctids:
+            row = by_ctid.pop(ctid, None)
+            if row and by_oid is not None:
+                by_oid.pop(row[1], None)
+
+    def prefetch(self, catalog, ctids):
+        """
+        Loads the catalog rows at the given ctids into the cache with one
+        query, ctids that don't match anything are cached as missing
+        """
+        by_ctid, by_oid = self._catalog[catalog]
+        ctids = [ctid for ctid in ctids if ctid not in by_ctid]
+        if not ctids:
+            return
+        query = self._catalog_queries[catalog].format('{}.ctid = ANY(%s::tid[])'.format(catalog))
         with self.con.cursor() as curs:
-            curs.execute(query, values)
-            ctid, oid, nspname = curs.fetchone()
-            return Schema(ctid, oid, nspname)
+            curs.execute(query, (ctids,))
+            rows = curs.fetchall()
+        for ctid in ctids:
+            by_ctid[ctid] = None
+        for row in rows:
+            self._cache(catalog, row)
 
-    def get_table(self, ctid=None, oid=None):
-        query = 'SELECT ctid, oid, relname, relnamespace, relkind FROM pg_class WHERE relkind = %s AND '
-        values = ['r']
+    def _cache(self, catalog, row):
+        by_ctid, by_oid = self._catalog[catalog]
+        by_ctid[row[0]] = row
+        if by_oid is not None:
+            by_oid[row[1]] = row
+
+    def _lookup(self, catalog, ctid=None, oid=None):
+        by_ctid, by_oid = self._catalog[catalog]
         if oid:
-            query += 'oid = %s'
-            values.append(oid)
+            cache, key, where = by_oid, oid, '{}.oid = %s'.format(catalog)
         else:
-            query += 'ctid = %s'
-            values.append(ctid)
+            cache, key, where = by_ctid, ctid, '{}.ctid = %s'.format(catalog)
+        if key in cache:
+            return cache[key]
+
         with self.con.cursor() as curs:
-            curs.execute(query, values)
-            ctid, oid, relname, relnamespace, relkind = curs.fetchone()
-            schema = self.get_schema(oid=relnamespace)
-            return Table(schema, ctid, oid, relname)
+            curs.execute(self._catalog_queries[catalog].format(where), (key,))
+            row = curs.fetchone()
+        if row:
+            self._cache(catalog, row)
+        else:
+            cache[key] = None
+        return row
+
+    def get_schema(self, ctid=None, oid=None):
+        row = self._lookup('pg_namespace', ctid=ctid, oid=oid)
+        if not row:
+            return None
+        ctid, oid, nspname = row
+        return Schema(ctid, oid, nspname)
+
+    def get_table(self, ctid=None, oid=None):
+        row = self._lookup('pg_class', ctid=ctid, oid=oid)
+        if not row:
+            return None
+        ctid, oid, relname, relnamespace, relkind = row
+        schema = self.get_schema(oid=relnamespace)
+        return Table(schema, ctid, oid, relname)
 
     def get_column(self, ctid=None, oid=None, update=None, internal_name=None):
-        query = """
-        SELECT pg_attribute.ctid, attrelid, attname, attnum, typname, atttypmod
-        FROM pg_attribute
-        LEFT JOIN pg_type ON pg_attribute.atttypid = pg_type.oid
-        WHERE %s AND attisdropped = false AND attnum > 0
-        ORDER BY attnum ASC
-        """
         if oid:
-            query %= 'attrelid = %s'
-            values = (oid,)
+            query = self._catalog_queries['pg_attribute'].format('attrelid = %s') + ' ORDER BY attnum ASC'
+            with self.con.cursor() as curs:
+                curs.execute(query, (oid,))
+                row = curs.fetchone()
         else:
-            query %= 'pg_attribute.ctid = %s'
-            values = (ctid,)
+            row = self._lookup('pg_attribute', ctid=ctid)
+        if not row:
+            return None
+        ctid, attrelid, attname, attnum, typname, atttypmod = row
+        table = self.get_table(oid=attrelid)
+        if not table:
+            return None
+        table.update = update
+        return Column(table, ctid, attname, attnum, typname, atttypmod, internal_name=internal_name)
+
+    def find_table(self, schema_name, name):
+        """
+        Looks up a table by name, without its columns
+        """
         with self.con.cursor() as curs:
-            curs.execute(query, values)
+            curs.execute("""
+            SELECT pg_class.oid FROM pg_class
+            JOIN pg_namespace ON pg_namespace.oid = relnamespace
+            WHERE nspname = %s AND relname = %s AND relkind = 'r'
+            """, (schema_name, name))
             row = curs.fetchone()
-            if not row:
-                return None
-            ctid, attrelid, attname, attnum, typname, atttypmod = row
-            table = self.get_table(oid=attrelid)
-            table.update = update
-            return Column(table, ctid, attname, attnum, typname, atttypmod, internal_name=internal_name)
+        if not row:
+            return None
+        return self.get_table(oid=row[0])
+
+    def key_columns(self, table):
+        """
+        Names of the columns logical decoding identifies the rows of table
+        by, those of its replica identity index or else its primary key
+        """
+        with self.con.cursor() as curs:
+            curs.execute("""
+            SELECT attname FROM pg_attribute
+            JOIN pg_index ON indrelid = attrelid AND attnum = ANY(indkey)
+            WHERE indexrelid = (
+                SELECT indexrelid FROM pg_index
+                WHERE indrelid = %s AND (indisreplident OR indisprimary)
+                ORDER BY indisreplident DESC LIMIT 1
+            )
+            ORDER BY attnum
+            """, (table.oid,))
+            return [name for name, in curs]
+
+    def replica_identity(self, table):
+        """
+        What logical decoding writes of the old version of a row: d(efault),
+        n(othing), f(ull) or i(ndex)
+        """
+        with self.con.cursor() as curs:
+            curs.execute('SELECT relreplident FROM pg_class WHERE oid = %s', (table.oid,))
+            return curs.fetchone()[0]
+
+    def replay_location(self):
+        """
+        The WAL position the slave has replayed up to
+        """
+        with self.con.cursor() as curs:
+            if self.con.server_version >= 100000:
+                curs.execute('SELECT pg_last_wal_replay_lsn()::text')
+            else:
+                curs.execute('SELECT pg_last_xlog_replay_location()')
+            return curs.fetchone()[0]
 
     def resume(self):
         self.logger.info('resuming')
@@ -172,6 +284,50 @@ class SlaveInspector(object):
             row = curs.fetchone()
             return row
 
+    def _get_many_query(self, table, tids, cols=None):
+        if cols:
+            cols = ', '.join(cols)
+        else:
+            cols = '*'
+        query = 'SELECT ctid, {} FROM {} WHERE ctid = ANY(%s::tid[])'
+        query = query.format(cols, table.long_name)
+        return query, (['({},{})'.format(block, offset) for block, offset in tids],)
+
+    def get_many(self, table, tids, cols=None):
+        """
+        Fetches the tuples at the given (block, offset) pairs in a single
+        query. Returns a dict keyed by ctid, tuples that no longer exist are
+        left out.
+        """
+        with self.con.cursor() as curs:
+            curs.execute(*self._get_many_query(table, tids, cols))
+            return dict((row[0], row[1:]) for row in curs)
+
+    def copy_rows(self, table, outfile):
+        """
+        Writes the ctid and columns of every row of table to outfile in the
+        COPY text format
+        """
+        with self.con.cursor() as curs:
+            curs.copy_expert('COPY (SELECT ctid, * FROM {}) TO STDOUT'.format(table.long_name), outfile)
+
+    def row_estimate(self, table):
+        with self.con.cursor() as curs:
+            curs.execute('SELECT reltuples FROM pg_class WHERE oid = %s', (table.oid,))
+            row = curs.fetchone()
+        return max(row[0], 0) if row else 0
+
+    def get_tables(self, requests):
+        """
+        get_many() for a list of (table, tids, cols) requests, returns a
+        list of dicts. With a fetcher the queries run concurrently.
+        """
+        if not self.fetcher or len(requests) < 2:
+            return [self.get_many(table, tids, cols) for table, tids, cols in requests]
+        results = self.fetcher.run(self._get_many_query(table, tids, cols)
+                                   for table, tids, cols in requests)
+        return [dict((row[0], row[1:]) for row in rows) for rows in results]
+
 
 class HistoryInspector(object):
 
@@ -188,7 +344,7 @@ class HistoryInspector(object):
         with self.con.cursor() as curs:
             curs.execute("""
             SELECT id, time
-            FROM marty_updates
+            FROM marty_updates WHERE complete
             ORDER BY time DESC LIMIT 1
             """)
             update_id, time = curs.fetchone()
@@ -208,18 +364,24 @@ class HistoryInspector(object):
     def tables(self, schema):
         with self.con.cursor() as curs:
             curs.execute("""
-            SELECT oid, ctid, name, internal_name
+            SELECT oid, _ctid, name, internal_name, EXISTS(
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = internal_name
+                  AND column_name = 'data_changed'
+            )
             FROM marty_tables
             WHERE schema = %(schema_id)s
               AND start <= %(update_id)s AND (stop IS NULL OR stop > %(update_id)s)
             """, {'schema_id': schema.oid, 'update_id': self.update})
-            for oid, ctid, name, internal_name in curs:
-                yield Table(schema, ctid, oid, name, internal_name=internal_name)
+            for oid, ctid, name, internal_name, delta in curs:
+                table = Table(schema, ctid, oid, name, internal_name=internal_name)
+                table.delta = delta
+                yield table
 
     def columns(self, table):
         with self.con.cursor() as curs:
             curs.execute("""
-            SELECT ctid, name, number, type, length, internal_name
+            SELECT _ctid, name, number, type, length, internal_name
             FROM marty_columns
             WHERE table_oid = %(table_oid)s
               AND start <= %(update_id)s AND (stop IS NULL OR stop > %(update_id)s)
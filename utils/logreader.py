@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import time
+import Queue
+import logging
+import threading
+from collections import deque
+
+
+class LogReader(object):
+    """
+    Reads log lines from a file in large chunks on a background thread, so
+    whatever writes the log never blocks on a full pipe while we are busy.
+
+    readline() blocks until a line is available and returns '' once the
+    input is exhausted, or raises the error reading it failed with. Regular
+    files are followed like tail -f.
+    """
+    chunk_size = 1 << 16
+    poll_interval = 0.1
+    backlog_warning = 100000
+
+    def __init__(self, infile, follow=None, logger=None):
+        self.infile = infile
+        self.fd = infile.fileno()
+        if follow is None:
+            follow = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.follow = follow
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger()
+            self.logger.addHandler(logging.NullHandler())
+
+        # Lists of lines, then None once the input is exhausted
+        self._queue = Queue.Queue()
+        self._ready = deque()
+        self._done = False
+        self._error = None
+        self._warn_at = self.backlog_warning
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.lines_taken = 0
+
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        partial = ''
+        try:
+            while True:
+                data = os.read(self.fd, self.chunk_size)
+                if not data:
+                    if self.follow:
+                        time.sleep(self.poll_interval)
+                        continue
+                    break
+                self.bytes_read += len(data)
+
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                if not lines:
+                    continue
+                self.lines_read += len(lines)
+                self._queue.put([line + '\n' for line in lines])
+                self._check_backlog()
+        except Exception as e:
+            # readline() raises it once the lines read before are handed out
+            self.logger.error('reading the log failed: {}'.format(e))
+            self._error = e
+            partial = ''
+        finally:
+            if partial:
+                self.lines_read += 1
+                self._queue.put([partial])
+            self._queue.put(None)
+
+    def _check_backlog(self):
+        backlog = self.backlog
+        if backlog >= self._warn_at:
+            self.logger.warning('{} log lines waiting to be replayed'.format(backlog))
+            self._warn_at *= 2
+        elif backlog < self._warn_at / 4 and self._warn_at > self.backlog_warning:
+            self._warn_at /= 2
+
+    @property
+    def backlog(self):
+        """
+        Number of lines read from the input but not handed out yet
+        """
+        return self.lines_read - self.lines_taken + len(self._ready)
+
+    @property
+    def finished(self):
+        self._take(block=False)
+        # Not with an error readline() has yet to raise
+        return self._done and not self._error and not self._ready
+
+    def _take(self, block):
+        """
+        Moves the next chunk of lines from the reader thread to the ready
+        ones, so we only lock once per chunk
+        """
+        if self._ready or self._done:
+            return
+        try:
+            lines = self._queue.get(block)
+        except Queue.Empty:
+            return
+        if lines is None:
+            self._done = True
+        else:
+            self._ready.extend(lines)
+            self.lines_taken += len(lines)
+
+    def readline(self):
+        self._take(block=True)
+        if self._ready:
+            return self._ready.popleft()
+        if self._error:
+            raise self._error
+        return ''
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+
+class ConnectionPool(object):
+    """
+    Autocommit connections to one database. get() returns the long lived
+    main connection, acquire() and release() hand out extra ones to worker
+    threads. A connection is only replaced when its health check fails.
+    """
+
+    def __init__(self, coninfo, size=4, logger=None):
+        self.coninfo = coninfo
+        self.size = size
+        self.con = None
+        self._idle = []
+        self._lock = threading.Lock()
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger()
+            self.logger.addHandler(logging.NullHandler())
+
+    def connect(self):
+        self.logger.info('connecting to {}'.format(self.coninfo.get('database')))
+        con = psycopg2.connect(**self.coninfo)
+        con.autocommit = True
+        return con
+
+    def healthy(self, con):
+        if con is None or con.closed:
+            return False
+        try:
+            if con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                return False
+            with con.cursor() as curs:
+                curs.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def get(self):
+        """
+        Returns the main connection, reconnecting only if it died
+        """
+        if not self.healthy(self.con):
+            self.discard(self.con)
+            self.con = self.connect()
+        return self.con
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                con = self._idle.pop()
+                if self.healthy(con):
+                    return con
+                self.discard(con)
+        return self.connect()
+
+    def release(self, con):
+        if not con.closed and con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                with con.cursor() as curs:
+                    curs.execute('ROLLBACK')
+            except psycopg2.Error:
+                pass
+        with self._lock:
+            if len(self._idle) < self.size and not con.closed:
+                self._idle.append(con)
+                return
+        self.discard(con)
+
+    def discard(self, con):
+        if con is not None and not con.closed:
+            try:
+                con.close()
+            except psycopg2.Error:
+                pass
+
+    def close(self):
+        with self._lock:
+            for con in self._idle:
+                self.discard(con)
+            self._idle = []
+        self.discard(self.con)
+        self.con = None
@@ -1,15 +1,39 @@
 # -*- coding: utf-8 -*-
 
+import re
+import hashlib
 import logging
+from collections import OrderedDict
 
 from dbobjects import Table, Column
+from copypipe import CopyPipe
+from stats import Stats
 
 
 class HistoryPopulator(object):
-
-    def __init__(self, con, logger=None):
+    batch_size = 1000
+    # Delta rows only store the columns in data_changed, the others are
+    # those of the full version at data_base_ctid and data_base_start
+    delta_columns = (('data_base_ctid', 'tid'), ('data_base_start', 'integer'), ('data_changed', 'int2[]'))
+    # Lookups by ctid only ever want the open version
+    catalog_indexes = (('marty_schemas', '_ctid'), ('marty_tables', '_ctid'), ('marty_columns', '_ctid'))
+
+    def __init__(self, con, logger=None, batch=False, partition_size=None, stats=None, delta=False):
         self.con = con
+        self.stats = stats or Stats()
+        self.delta = delta
         self.update_id = None
+        self.lsn = None
+        self.batch = batch
+        # With a partition size data tables are partitioned by ranges of start
+        self.partition_size = partition_size
+        self._partition = None
+        self._inserts = OrderedDict()
+        self._deletes = OrderedDict()
+        self._key_deletes = OrderedDict()
+        # Statements per (internal table name, kind), see statement()
+        self._statements = {}
+        self._statement_count = 0
         if logger:
             self.logger = logger
         else:
@@ -25,9 +49,13 @@ class HistoryPopulator(object):
             CREATE TABLE IF NOT EXISTS marty_updates(
                 id SERIAL PRIMARY KEY,
                 time TIMESTAMP DEFAULT current_timestamp NOT NULL,
-                mastertime TIMESTAMP NOT NULL
+                mastertime TIMESTAMP NOT NULL,
+                lsn text,
+                complete boolean DEFAULT true NOT NULL
             )
             """)
+            self._add_missing_column(curs, 'marty_updates', 'lsn', 'text')
+            self._add_missing_column(curs, 'marty_updates', 'complete', 'boolean DEFAULT true NOT NULL')
 
             # marty_schemas
             curs.execute("""
@@ -68,14 +96,272 @@ class HistoryPopulator(object):
             )
             """)
 
-    def update(self, mastertime):
+            for table_name, column_name in self.catalog_indexes:
+                self.create_index(curs, table_name, column_name)
+
+    def has_column(self, curs, table, column):
+        curs.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+        """, (table, column))
+        return curs.fetchone() is not None
+
+    def _add_missing_column(self, curs, table, column, definition):
+        # For history databases created before the column was added
+        if not self.has_column(curs, table, column):
+            curs.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, definition))
+
+    def index_name(self, table_name, column_name):
+        name = '{}_{}_open'.format(table_name, re.sub(r'\W+', '_', column_name.lstrip('_')))
+        if len(name) > 63:
+            # Postgres cuts identifiers at 63 bytes, cut down to the table
+            # name it would clash with the table
+            suffix = '_{}_open'.format(hashlib.md5(name).hexdigest()[:8])
+            name = name[:63 - len(suffix)] + suffix
+        return name
+
+    def find_index(self, curs, table_name, column_name):
+        """
+        The name of the partial index on the open versions of table_name,
+        whatever it was named when it was created, or None
+        """
+        curs.execute("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass AND i.indpred IS NOT NULL AND ARRAY(
+            SELECT a.attname::text FROM generate_subscripts(i.indkey::int2[], 1) k
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[k]
+            ORDER BY k
+        ) = %s::text[]
+        """, (table_name, [name.strip() for name in column_name.split(',')]))
+        row = curs.fetchone()
+        return row and row[0]
+
+    def create_index(self, curs, table_name, column_name, concurrently=False):
+        """
+        Creates the partial index on the open versions of table_name, returns
+        False if it already exists
+        """
+        if self.find_index(curs, table_name, column_name):
+            return False
+        name = self.index_name(table_name, column_name)
+        self.logger.info('creating index {}'.format(name))
+        curs.execute('CREATE INDEX {} {} ON {}({}) WHERE stop IS NULL'.format(
+            'CONCURRENTLY' if concurrently else '', name, table_name, column_name))
+        return True
+
+    def check_indexes(self, rebuild=False):
+        """
+        Creates the indexes missing from an existing history database and
+        rebuilds the ones left invalid by a failed build. With rebuild every
+        index is rebuilt. Returns the names of the created and rebuilt indexes.
+        """
+        with self.con.cursor() as curs:
+            targets = [(table_name, column_name, False) for table_name, column_name in self.catalog_indexes]
+            targets.extend((name, 'data_ctid', partitioned) for name, partitioned in self.data_tables(curs))
+
+            # Concurrent builds don't block replay on big history tables,
+            # partitioned tables can't build their indexes concurrently
+            created = []
+            for table_name, column_name, partitioned in targets:
+                concurrently = self.con.autocommit and not partitioned
+                if self.create_index(curs, table_name, column_name, concurrently=concurrently):
+                    created.append(self.index_name(table_name, column_name))
+
+            names = [self.find_index(curs, table_name, column_name) for table_name, column_name, _ in targets]
+            names = [name for name in names if name]
+            if not rebuild:
+                curs.execute("""
+                SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE NOT i.indisvalid AND c.relname = ANY(%s)
+                """, (names,))
+                names = [name for name, in curs.fetchall()]
+            for name in names:
+                self.logger.info('rebuilding index {}'.format(name))
+                curs.execute('REINDEX INDEX {}'.format(name))
+
+        return created, names
+
+    def add_delta_columns(self):
+        """
+        Adds the delta storage columns to the data tables created without them
+        """
+        with self.con.cursor() as curs:
+            for table_name, partitioned in self.data_tables(curs):
+                for name, type in self.delta_columns:
+                    self._add_missing_column(curs, table_name, name, type)
+
+    def update(self, mastertime, lsn=None, complete=True):
+        """
+        Starts a new update for a master commit, lsn is the WAL position of
+        the commit and is what replay resumes from after a restart. An
+        update that is not complete is ignored until complete_updates().
+        """
         with self.con.cursor() as curs:
             curs.execute("""
-            INSERT INTO marty_updates(mastertime) VALUES(%s) RETURNING id
-            """, (mastertime,))
+            INSERT INTO marty_updates(mastertime, lsn, complete) VALUES(%s, %s, %s) RETURNING id
+            """, (mastertime, lsn, complete))
             self.update_id = curs.fetchone()[0]
+            if lsn:
+                self.lsn = lsn
             self.logger.debug('new update id {}'.format(self.update_id))
 
+            if self.partition_size and self.update_id // self.partition_size != self._partition:
+                self.create_partitions(curs)
+
+    def checkpoint(self):
+        """
+        Picks up the last update, returns its (id, mastertime, lsn) or None
+        if nothing has been replayed yet
+        """
+        with self.con.cursor() as curs:
+            curs.execute("""
+            SELECT id, mastertime, lsn FROM marty_updates WHERE complete ORDER BY id DESC LIMIT 1
+            """)
+            row = curs.fetchone()
+        if row:
+            self.update_id = row[0]
+            self.lsn = row[2]
+            self.logger.info('last update {} from {} at {}'.format(*row))
+        return row
+
+    def complete_updates(self, update_ids):
+        with self.con.cursor() as curs:
+            curs.execute('UPDATE marty_updates SET complete = true WHERE id = ANY(%s)', (update_ids,))
+
+    def rollback_incomplete(self):
+        """
+        Undoes the updates a sharded writer did not complete, some of their
+        shards may have committed before replay stopped, and a bootstrap or
+        refill stopped before all its tables were filled. The data tables
+        those created are dropped, so an interrupted bootstrap leaves an
+        empty history database.
+        """
+        with self.con.cursor() as curs:
+            curs.execute('SELECT id FROM marty_updates WHERE NOT complete ORDER BY id')
+            updates = [update_id for update_id, in curs.fetchall()]
+            if not updates:
+                return
+            self.logger.warning('rolling back incomplete updates {}'.format(updates))
+            curs.execute("""
+            SELECT internal_name FROM marty_tables
+            GROUP BY internal_name
+            HAVING bool_and(start = ANY(%s))
+            """, (updates,))
+            created = set(table_name for table_name, in curs.fetchall())
+            for table_name, partitioned in self.data_tables(curs):
+                if table_name in created:
+                    self.logger.warning('dropping table {}'.format(table_name))
+                    self.invalidate_statements(table_name)
+                    curs.execute('DROP TABLE {}'.format(table_name))
+                    continue
+                curs.execute('DELETE FROM {} WHERE start = ANY(%s)'.format(table_name), (updates,))
+                curs.execute('UPDATE {} SET stop = NULL WHERE stop = ANY(%s)'.format(table_name), (updates,))
+            for catalog in ('marty_schemas', 'marty_tables', 'marty_columns'):
+                curs.execute('DELETE FROM {} WHERE start = ANY(%s)'.format(catalog), (updates,))
+                curs.execute('UPDATE {} SET stop = NULL WHERE stop = ANY(%s)'.format(catalog), (updates,))
+            curs.execute('DELETE FROM marty_updates WHERE id = ANY(%s)', (updates,))
+
+    def begin(self):
+        """
+        Starts a history transaction, everything written until commit() is
+        committed at once
+        """
+        self.con.autocommit = False
+
+    def commit(self):
+        with self.stats.timer('flush'):
+            self.flush()
+        with self.stats.timer('commit'):
+            self.con.commit()
+        self.con.autocommit = True
+
+    def flush(self):
+        """
+        Writes out the inserts and deletes queued in batch mode. Inserts go
+        first so rows inserted and deleted in the same update get closed.
+        """
+        with self.con.cursor() as curs:
+            for table, rows in self._inserts.itervalues():
+                self.logger.info('inserting {} rows to table {}'.format(len(rows), table.internal_name))
+                query, value_list = self.statement(curs, table, 'values')
+                for i in range(0, len(rows), self.batch_size):
+                    values = ', '.join(curs.mogrify(value_list, row) for row in rows[i:i + self.batch_size])
+                    curs.execute(query + values)
+                self.stats.count('rows_inserted', len(rows))
+
+            for table, ctids in self._deletes.itervalues():
+                self.logger.info('deleting {} rows from table {}'.format(len(ctids), table.internal_name))
+                curs.execute(self.statement(curs, table, 'delete'), (self.update_id, ctids))
+                self.stats.count('rows_deleted', len(ctids))
+
+            for table, keys in self._key_deletes.itervalues():
+                self.logger.info('deleting {} rows by key from table {}'.format(len(keys), table.internal_name))
+                for i in range(0, len(keys), self.batch_size):
+                    curs.execute('; '.join(curs.mogrify(*self.key_delete(table, key))
+                                           for key in keys[i:i + self.batch_size]))
+                self.stats.count('rows_deleted', len(keys))
+
+        self._inserts.clear()
+        self._deletes.clear()
+        self._key_deletes.clear()
+
+    def statement(self, curs, table, kind):
+        """
+        The statement for writing to a data table, built once per table.
+        'insert' is prepared on the server and returns an EXECUTE taking the
+        row, so only its values are sent. 'values' returns the start of a
+        multi-row INSERT and the VALUES list of one row, one multi-row INSERT
+        is faster than as many EXECUTEs. 'delete' takes the update id and a
+        ctid list. It is not prepared: the plan cached for a nearly empty
+        table scans all of it once the table has grown.
+        """
+        key = (table.internal_name, kind)
+        statement = self._statements.get(key)
+        if statement is not None:
+            return statement
+
+        column_names = self.column_names(table)
+        if kind == 'values':
+            statement = ('INSERT INTO {}({}) VALUES '.format(table.internal_name, ', '.join(column_names)),
+                         '({})'.format(', '.join('%s' for name in column_names)))
+        elif kind == 'insert':
+            name = self._prepare(curs, 'INSERT INTO {}({}) VALUES({})'.format(
+                table.internal_name, ', '.join(column_names),
+                ', '.join('${}'.format(i + 1) for i in range(len(column_names)))))
+            statement = 'EXECUTE {}({})'.format(name, ', '.join('%s' for name in column_names))
+        else:
+            statement = 'UPDATE {} SET stop = %s WHERE data_ctid = ANY(%s::tid[]) AND stop IS NULL'.format(
+                table.internal_name)
+        self._statements[key] = statement
+        return statement
+
+    def _prepare(self, curs, query):
+        self._statement_count += 1
+        name = 'marty_statement_{}'.format(self._statement_count)
+        curs.execute('PREPARE {} AS {}'.format(name, query))
+        self.stats.count('statements_prepared')
+        return name
+
+    def invalidate_statements(self, table_name):
+        """
+        Forgets the statements of a data table whose columns change or that
+        is no longer written to. Prepared statements outlive transactions so
+        they are deallocated.
+        """
+        with self.con.cursor() as curs:
+            for kind in 'insert', 'delete', 'values':
+                statement = self._statements.pop((table_name, kind), None)
+                if statement is not None and kind == 'insert':
+                    name = statement.split()[1].partition('(')[0]
+                    curs.execute('DEALLOCATE {}'.format(name))
+
+    def reset_statements(self):
+        """
+        Forgets every statement, after another populator changed the tables
+        """
+        for table_name in set(table_name for table_name, kind in self._statements):
+            self.invalidate_statements(table_name)
+
     def add_schema(self, schema):
         self.logger.info('adding schema {}'.format(schema.name))
 
@@ -89,7 +375,7 @@ class HistoryPopulator(object):
 
         with self.con.cursor() as curs:
             curs.execute("""
-            UPDATE marty_schemas SET stop = %s WHERE _ctid = %s
+            UPDATE marty_schemas SET stop = %s WHERE _ctid = %s AND stop IS NULL
             """, (self.update_id, ctid))
 
     def add_table(self, table):
@@ -113,8 +399,12 @@ class HistoryPopulator(object):
 
         with self.con.cursor() as curs:
             curs.execute("""
-            UPDATE marty_tables SET stop = %s WHERE _ctid = %s
+            UPDATE marty_tables SET stop = %s WHERE _ctid = %s AND stop IS NULL
+            RETURNING internal_name
             """, (self.update_id, ctid))
+            table_names = set(name for name, in curs.fetchall())
+        for table_name in table_names:
+            self.invalidate_statements(table_name)
 
     def add_column(self, column):
         self.logger.info('adding column {} to {}'.format(column.name, column.table.long_name))
@@ -133,7 +423,7 @@ class HistoryPopulator(object):
 
         with self.con.cursor() as curs:
             curs.execute("""
-            UPDATE marty_columns SET stop = %s WHERE _ctid = %s
+            UPDATE marty_columns SET stop = %s WHERE _ctid = %s AND stop IS NULL
             """, (self.update_id, ctid))
 
     def create_table(self, table):
@@ -141,7 +431,12 @@ class HistoryPopulator(object):
 
         with self.con.cursor() as curs:
             cols = ','.join('\n  {} {}'.format(column.internal_name, column.type) for column in table.internal_columns)
-            curs.execute('CREATE TABLE {}({})'.format(table.internal_name, cols))
+            if self.delta:
+                cols += ''.join(',\n  {} {}'.format(name, type) for name, type in self.delta_columns)
+            query = 'CREATE TABLE {}({})'
+            if self.partition_size:
+                query += ' PARTITION BY RANGE (start)'
+            curs.execute(query.format(table.internal_name, cols))
 
             self.logger.debug(curs.query)
 
@@ -155,7 +450,89 @@ class HistoryPopulator(object):
                 WHERE attrelid = %s AND attname = %s
                 """, (column.length, table_oid, column.internal_name))
 
+            self.create_index(curs, table.internal_name, 'data_ctid')
+            if self.partition_size:
+                # Partitions copy the column lengths we just set
+                self.create_partition(curs, table.internal_name, self.update_id // self.partition_size)
+
+    def partition_name(self, table_name, number):
+        suffix = '_p{}'.format(number)
+        return table_name[:63 - len(suffix)] + suffix
+
+    def create_partition(self, curs, table_name, number):
+        name = self.partition_name(table_name, number)
+        self.logger.info('creating partition {}'.format(name))
+        curs.execute('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)'.format(
+            name, table_name), (number * self.partition_size, (number + 1) * self.partition_size))
+
+    def data_tables(self, curs):
+        """
+        The names of the data tables and whether each is partitioned
+        """
+        curs.execute("""
+        SELECT relname, relkind = 'p' FROM pg_class
+        WHERE relkind IN ('r', 'p') AND relnamespace = (SELECT oid FROM pg_namespace WHERE nspname = current_schema())
+            AND relname IN (SELECT internal_name FROM marty_tables)
+        ORDER BY relname
+        """)
+        return curs.fetchall()
+
+    def partitioned_tables(self, curs):
+        return [name for name, partitioned in self.data_tables(curs) if partitioned]
+
+    def create_partitions(self, curs):
+        """
+        Makes sure every partitioned data table has a partition for the
+        current update, run when the update id enters a new range
+        """
+        number = self.update_id // self.partition_size
+        for table_name in self.partitioned_tables(curs):
+            self.create_partition(curs, table_name, number)
+        self._partition = number
+
+    def detach_partitions(self, horizon):
+        """
+        Detaches the partitions that only hold versions started and stopped
+        before the update id horizon, they are no longer needed for clones
+        after it. Returns the names of the detached partitions, which are
+        left as plain tables.
+        """
+        detached = []
+        with self.con.cursor() as curs:
+            for table_name in self.partitioned_tables(curs):
+                delta = self.has_column(curs, table_name, 'data_changed')
+                curs.execute("""
+                SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = %s::regclass
+                """, (table_name,))
+                for name, bound in curs.fetchall():
+                    # Later updates could still be inserted before the upper bound
+                    upper = re.search(r'TO \((\d+)\)', bound)
+                    if not upper or int(upper.group(1)) > horizon:
+                        continue
+                    curs.execute("""
+                    SELECT 1 FROM {} WHERE stop IS NULL OR stop > %s LIMIT 1
+                    """.format(name), (horizon,))
+                    if curs.fetchone():
+                        continue
+                    if delta:
+                        # Delta versions still needing a base version in here
+                        lower = re.search(r'FROM \((\d+)\)', bound)
+                        curs.execute("""
+                        SELECT 1 FROM {} WHERE data_base_start >= %s AND data_base_start < %s
+                          AND (stop IS NULL OR stop > %s) LIMIT 1
+                        """.format(table_name), (int(lower.group(1)), int(upper.group(1)), horizon))
+                        if curs.fetchone():
+                            continue
+                    self.logger.info('detaching partition {} {}'.format(name, bound))
+                    curs.execute('ALTER TABLE {} DETACH PARTITION {}'.format(table_name, name))
+                    detached.append(name)
+        return detached
+
     def add_data_column(self, column):
+        self.flush()
+        self.invalidate_statements(column.table.internal_name)
         with self.con.cursor() as curs:
             curs.execute("""
             ALTER TABLE {} ADD COLUMN {} {}
@@ -164,11 +541,17 @@ class HistoryPopulator(object):
             curs.execute('SELECT oid FROM pg_class WHERE relname = %s', (column.table.internal_name,))
             table_oid, = curs.fetchone()
 
+            # The column is added to every partition as well
             curs.execute("""
             UPDATE pg_attribute
             SET atttypmod = %s
-            WHERE attrelid = %s AND attname = %s
-            """, (column.length, table_oid, column.internal_name))
+            WHERE attname = %s AND (attrelid = %s OR attrelid IN (
+                SELECT inhrelid FROM pg_inherits WHERE inhparent = %s
+            ))
+            """, (column.length, column.internal_name, table_oid, table_oid))
+
+            # Tables from before indexes were managed get theirs here
+            self.create_index(curs, column.table.internal_name, 'data_ctid')
 
     def fill_table(self, table):
         self.logger.info('filling table {}'.format(table.internal_name))
@@ -186,27 +569,187 @@ class HistoryPopulator(object):
 
                 self.logger.debug(curs.query)
 
-    def insert(self, table, block, offset, row):
-        self.logger.info('inserting to table {}'.format(table.internal_name))
-        table_name = table.internal_name
-        column_names = ', '.join(column.internal_name for column in table.internal_columns)
-        value_list = ', '.join('%s' for column in table.internal_columns)
-        query = 'INSERT INTO {}({}) VALUES({})'.format(table_name, column_names, value_list)
+    def copy_table(self, table):
+        """
+        Fills the table by streaming a COPY from the slave straight into a
+        COPY on the history database
+        """
+        self.logger.info('copying table {}'.format(table.internal_name))
 
+        column_names = ', '.join(column.internal_name for column in table.internal_columns)
+        query = 'COPY {}({}) FROM STDIN'.format(table.internal_name, column_names)
+
+        pipe = CopyPipe()
+        pipe.produce(table.copy_data, self.update_id)
+        try:
+            with self.con.cursor() as curs:
+                curs.copy_expert(query, pipe)
+        except Exception:
+            pipe.close(raise_error=False)
+            raise
+        else:
+            pipe.close()
+
+    def column_names(self, table):
+        names = [column.internal_name for column in table.internal_columns]
+        if self.delta:
+            names.extend(name for name, type in self.delta_columns)
+        return names
+
+    def insert(self, table, block, offset, row, version=None):
+        """
+        Inserts a new version of a row. A version list is filled with the
+        (ctid, update id) delta rows refer to this version by.
+        """
+        ctid = '({},{})'.format(block, offset)
+        values = [ctid] + list(row) + [self.update_id, None]
+        if self.delta:
+            values.extend((None, None, None))
+        if version is not None:
+            version[:] = [ctid, self.update_id]
+        self._insert(table, values)
+
+    def insert_delta(self, table, block, offset, row, changed, base):
+        """
+        Inserts a version storing only the changed columns (by number), the
+        others are found in the base version
+        """
         values = ['({},{})'.format(block, offset)] + list(row) + [self.update_id, None]
+        values.extend((base[0], base[1], changed))
+        self._insert(table, values)
+
+    def _insert(self, table, values):
+        if self.batch:
+            self._inserts.setdefault(table.internal_name, (table, []))[1].append(values)
+            return
+
+        self.logger.info('inserting to table {}'.format(table.internal_name))
         with self.con.cursor() as curs:
-            curs.execute(query, values)
+            curs.execute(self.statement(curs, table, 'insert'), values)
             self.logger.debug(curs.query)
+        self.stats.count('rows_inserted')
 
     def delete(self, table, block, offset):
+        ctid = '({},{})'.format(block, offset)
+        if self.batch:
+            self._deletes.setdefault(table.internal_name, (table, []))[1].append(ctid)
+            return
         self.logger.info('deleting from table {}'.format(table.internal_name))
-        query = 'UPDATE {} SET stop = %s WHERE data_ctid = %s'.format(table.internal_name)
-        values = [self.update_id, '({},{})'.format(block, offset)]
         with self.con.cursor() as curs:
-            curs.execute(query, values)
+            curs.execute(self.statement(curs, table, 'delete'), (self.update_id, [ctid]))
+            self.logger.debug(curs.query)
+        self.stats.count('rows_deleted')
+
+    def insert_version(self, table, row, key=None, unchanged=()):
+        """
+        Inserts a version of a row from logical decoding, which has no ctid.
+        The columns in unchanged (by position in row) were not sent and are
+        copied from the open version with key.
+        """
+        values = [None] + list(row) + [self.update_id, None]
+        if not unchanged or not key:
+            self._insert(table, values)
+            return
+
+        select = []
+        params = []
+        for i, column in enumerate(table.columns):
+            if i in unchanged:
+                select.append('old.{}'.format(column.internal_name))
+            else:
+                select.append('%s')
+                params.append(row[i])
+        condition, key_values = self.key_condition(key, 'old')
+        query = """
+        INSERT INTO {table}({columns}) SELECT NULL, {select}, %s, NULL FROM {table} old
+        WHERE {condition} AND old.stop IS NULL AND old.start < %s LIMIT 1
+        """.format(table=table.internal_name, select=', '.join(select), condition=condition,
+                   columns=', '.join(column.internal_name for column in table.internal_columns))
+        with self.con.cursor() as curs:
+            curs.execute(query, params + [self.update_id] + key_values + [self.update_id])
+            found = curs.rowcount
+        if found:
+            self.stats.count('rows_inserted')
+        else:
+            self.logger.warning('no version of {} in {} to take unchanged columns from'.format(
+                key, table.internal_name))
+            self._insert(table, values)
+
+    def delete_key(self, table, key):
+        """
+        Closes the open version written before this update of the row with
+        key, a list of (column, value) pairs
+        """
+        if self.batch:
+            self._key_deletes.setdefault(table.internal_name, (table, []))[1].append(key)
+            return
+        self.logger.info('deleting by key from table {}'.format(table.internal_name))
+        with self.con.cursor() as curs:
+            curs.execute(*self.key_delete(table, key))
             self.logger.debug(curs.query)
+        self.stats.count('rows_deleted')
+
+    def key_delete(self, table, key):
+        # Versions this update wrote are left open, so closes and inserts of
+        # the same key may run in any order
+        condition, values = self.key_condition(key)
+        query = 'UPDATE {} SET stop = %s WHERE {} AND stop IS NULL AND start < %s'.format(
+            table.internal_name, condition)
+        return query, [self.update_id] + values + [self.update_id]
+
+    def key_condition(self, key, alias=None):
+        prefix = '{}.'.format(alias) if alias else ''
+        conditions = []
+        values = []
+        for column, value in key:
+            if value is None:
+                conditions.append('{}{} IS NULL'.format(prefix, column.internal_name))
+            else:
+                conditions.append('{}{} = %s'.format(prefix, column.internal_name))
+                values.append(value)
+        return ' AND '.join(conditions), values
+
+    def create_key_index(self, table, columns):
+        """
+        Creates the index deletes by key find the open versions with
+        """
+        with self.con.cursor() as curs:
+            self.create_index(curs, table.internal_name, ', '.join(column.internal_name for column in columns))
+
+    def bulk_diff(self, table, infile):
+        """
+        Brings the open versions of table in line with infile, a COPY of the
+        ctid and columns of all its rows. A heap tuple never changes in
+        place, so versions whose ctid is gone are closed and rows at ctids
+        without an open version are inserted.
+        """
+        self.logger.info('diffing table {}'.format(table.internal_name))
+        columns = ', '.join(column.internal_name for column in table.columns)
+        with self.con.cursor() as curs:
+            curs.execute('DROP TABLE IF EXISTS marty_bulk')
+            curs.execute('CREATE TEMP TABLE marty_bulk ON COMMIT DROP AS SELECT data_ctid, {} FROM {} WITH NO DATA'.format(
+                columns, table.internal_name))
+            infile.seek(0)
+            curs.copy_expert('COPY marty_bulk FROM STDIN', infile)
+            curs.execute('ANALYZE marty_bulk')
+
+            curs.execute("""
+            UPDATE {table} SET stop = %s
+            WHERE stop IS NULL AND NOT EXISTS (SELECT 1 FROM marty_bulk b WHERE b.data_ctid = {table}.data_ctid)
+            """.format(table=table.internal_name), (self.update_id,))
+            self.stats.count('rows_deleted', curs.rowcount)
+            curs.execute("""
+            INSERT INTO {table}(data_ctid, {columns}, start)
+            SELECT b.data_ctid, {columns}, %s FROM marty_bulk b
+            WHERE NOT EXISTS (SELECT 1 FROM {table} d WHERE d.data_ctid = b.data_ctid AND d.stop IS NULL)
+            """.format(table=table.internal_name, columns=columns), (self.update_id,))
+            self.stats.count('rows_inserted', curs.rowcount)
+            curs.execute('DROP TABLE marty_bulk')
+        infile.close()
 
     def delete_all(self, table):
+        self.flush()
+        self.invalidate_statements(table.internal_name)
         query = 'UPDATE {} SET stop = %s WHERE stop IS NULL'.format(table.internal_name)
         values = (self.update_id,)
         with self.con.cursor() as curs:
@@ -217,7 +760,7 @@ class HistoryPopulator(object):
             curs.execute("""
             SELECT _ctid, oid, name, internal_name
             FROM marty_tables
-            WHERE _ctid = %s""", (ctid,))
+            WHERE _ctid = %s AND stop IS NULL""", (ctid,))
             row = curs.fetchone()
             if not row:
                 return
@@ -229,7 +772,7 @@ class HistoryPopulator(object):
             curs.execute("""
             SELECT _ctid, table_oid, name, number, type, length, internal_name
             FROM marty_columns
-            WHERE _ctid = %s""", (ctid,))
+            WHERE _ctid = %s AND stop IS NULL""", (ctid,))
             row = curs.fetchone()
             if not row:
                 return
@@ -238,11 +781,20 @@ class HistoryPopulator(object):
 
 
 class ClonePopulator(object):
-
-    def __init__(self, con, update, history_coninfo, logger=None):
+    """
+    Creates views in the clone database showing the history tables as of
+    `update`. A view copies its whole table from history the first time it
+    is read, or, when `lazy`, only the rows asked for with
+    view_fetch('schema.table', 'predicate'), like "id BETWEEN 1 AND 1000".
+    Reading a lazy view before all of it is fetched is an error, unless
+    marty.partial_reads is set on.
+    """
+
+    def __init__(self, con, update, history_coninfo, logger=None, lazy=False):
         self.con = con
         self.update = update
         self.history_coninfo = history_coninfo
+        self.lazy = lazy
         if logger:
             self.logger = logger
         else:
@@ -258,6 +810,8 @@ class ClonePopulator(object):
                 view_name name UNIQUE,
                 local_table name,
                 cached boolean DEFAULT false,
+                lazy boolean DEFAULT false,
+                fetched text[] DEFAULT '{}',
                 coldef text,
                 remote_select_stmt text,
                 temp_table_def text
@@ -272,19 +826,73 @@ class ClonePopulator(object):
             $$ LANGUAGE plpgsql;
             """.format(coninfo=self._dblink_connstr()))
 
+            # A view cannot see the WHERE clause it is queried with, so rows
+            # are fetched by predicate explicitly. Rows an earlier predicate
+            # matched are local already, maybe changed or deleted there, and
+            # are left out of later fetches.
+            curs.execute("""
+            CREATE FUNCTION view_fetch(my_view_name text, predicate text DEFAULT 'true') RETURNS bigint AS $$
+            DECLARE
+                view_info RECORD;
+                remote_query text;
+                fetched_rows bigint;
+            BEGIN
+                SELECT * INTO view_info FROM marty.bookkeeping WHERE view_name = my_view_name FOR UPDATE;
+                IF NOT FOUND THEN
+                    RAISE EXCEPTION 'no clone view %', my_view_name;
+                END IF;
+                IF view_info.cached OR predicate = ANY(view_info.fetched) THEN
+                    RETURN 0;
+                END IF;
+                RAISE NOTICE 'fetching % where %', view_info.view_name, predicate;
+                remote_query := 'SELECT * FROM (' || view_info.remote_select_stmt || ') v WHERE (' || predicate || ')' ||
+                        coalesce((SELECT string_agg(' AND NOT coalesce((' || p || '), false)', '')
+                                  FROM unnest(view_info.fetched) p), '');
+                EXECUTE ' INSERT INTO ' || view_info.local_table ||
+                        ' SELECT ' || view_info.coldef ||
+                        ' FROM dblink(' || quote_literal(coninfo()) || ', ' || quote_literal(remote_query) || ')'
+                        ' AS ' || view_info.temp_table_def;
+                GET DIAGNOSTICS fetched_rows = ROW_COUNT;
+                IF predicate = 'true' THEN
+                    UPDATE marty.bookkeeping SET cached = true WHERE view_name = my_view_name;
+                ELSE
+                    UPDATE marty.bookkeeping SET fetched = array_append(fetched, predicate)
+                    WHERE view_name = my_view_name;
+                END IF;
+                RETURN fetched_rows;
+            END;
+            $$ LANGUAGE plpgsql;
+            """)
+
             curs.execute("""
             CREATE FUNCTION view_select(my_view_name text) RETURNS SETOF RECORD AS $$
             DECLARE
                 view_info RECORD;
+                missing text;
+                partial boolean;
             BEGIN
                 SELECT * FROM marty.bookkeeping WHERE view_name = my_view_name INTO view_info;
-                IF NOT view_info.cached THEN
-                    RAISE NOTICE 'fetching %', view_info.view_name;
-                    EXECUTE ' INSERT INTO ' || view_info.local_table ||
-                            ' SELECT ' || view_info.coldef ||
-                            ' FROM dblink(''' || coninfo() || ''', ''' || view_info.remote_select_stmt || ''')'
-                            ' AS ' || view_info.temp_table_def;
-                    UPDATE marty.bookkeeping SET cached = true WHERE view_name = my_view_name;
+                IF NOT view_info.cached AND NOT view_info.lazy THEN
+                    PERFORM view_fetch(my_view_name);
+                ELSIF NOT view_info.cached THEN
+                    -- The query's own WHERE clause is out of sight, so it may
+                    -- ask for rows that were never fetched
+                    IF coalesce(array_length(view_info.fetched, 1), 0) = 0 THEN
+                        missing := 'no rows of ' || view_info.view_name || ' are fetched yet';
+                    ELSE
+                        missing := view_info.view_name || ' only has the rows where (' ||
+                                array_to_string(view_info.fetched, ') OR (') || ')';
+                    END IF;
+                    BEGIN
+                        partial := current_setting('marty.partial_reads') = 'on';
+                    EXCEPTION WHEN undefined_object THEN
+                        partial := false;
+                    END;
+                    IF NOT partial THEN
+                        RAISE EXCEPTION '%', missing USING HINT =
+                                'fetch the rows with view_fetch(), or SET marty.partial_reads = on to read them anyway';
+                    END IF;
+                    RAISE NOTICE '%', missing;
                 END IF;
                 RETURN QUERY EXECUTE 'SELECT ' || view_info.coldef || ' FROM ' || view_info.local_table;
             END;
@@ -336,15 +944,28 @@ class ClonePopulator(object):
             curs.execute(view_query.format(view_name=table.long_name, cols=my_cols, tabledef=temp_table_def))
 
             bookkeeping_query = """
-            INSERT INTO marty.bookkeeping(view_name, local_table, coldef, remote_select_stmt, temp_table_def)
-            VALUES(%(view_name)s, %(local_table)s, %(coldef)s, %(remote_select_stmt)s, %(temp_table_def)s);
+            INSERT INTO marty.bookkeeping(view_name, local_table, lazy, coldef, remote_select_stmt, temp_table_def)
+            VALUES(%(view_name)s, %(local_table)s, %(lazy)s, %(coldef)s, %(remote_select_stmt)s, %(temp_table_def)s);
             """
             local_cols = ', '.join(['"{}"'.format(col.name) for col in table.columns])
-            internal_cols = ', '.join([col.internal_name for col in table.columns])
+            # Named like the view's columns, so fetch predicates can use them
+            internal_cols = ', '.join(['{} AS "{}"'.format(col.internal_name, col.name) for col in table.columns])
             remote_select_stmt = 'SELECT {cols} FROM {table} WHERE start <= {update} and (stop IS NULL or stop > {update})'
+            if table.delta:
+                # Columns a delta version did not change come from its base
+                # version. No quotes, this ends up in a dblink string.
+                internal_cols = ', '.join(
+                    'CASE WHEN d.data_changed IS NULL OR {number} = ANY(d.data_changed) '
+                    'THEN d.{name} ELSE b.{name} END AS "{alias}"'.format(
+                        number=col.number, name=col.internal_name, alias=col.name)
+                    for col in table.columns)
+                remote_select_stmt = ('SELECT {cols} FROM {table} d LEFT JOIN {table} b '
+                    'ON b.data_ctid = d.data_base_ctid AND b.start = d.data_base_start '
+                    'WHERE d.start <= {update} and (d.stop IS NULL or d.stop > {update})')
             bookkeeping_values = {
                 'view_name': table.long_name,
                 'local_table': 'marty.' + table.internal_name,
+                'lazy': self.lazy,
                 'coldef': local_cols,
                 'remote_select_stmt': remote_select_stmt.format(cols=internal_cols, table=table.internal_name, update=self.update),
                 'temp_table_def': temp_table_def,
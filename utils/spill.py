@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import struct
+import tempfile
+
+
+class SpillFile(object):
+    """
+    The heap records of a transaction too large to keep in memory, packed
+    into a temporary file. Records are (action, rel_node, block, offset,
+    new_block, new_offset) tuples as the LogParser returns them and are read
+    back in the order they were written, in lists of at most `size`.
+    """
+    actions = ('insert', 'update', 'delete')
+    record = struct.Struct('=BIIHIH')
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.count = 0
+        self._file = None
+        self._codes = dict((action, code) for code, action in enumerate(self.actions))
+
+    def write(self, records):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='marty-spill-', dir=self.directory)
+        pack = self.record.pack
+        codes = self._codes
+        self._file.write(b''.join(pack(codes[action], rel_node, block, offset, new_block, new_offset)
+                                  for action, rel_node, block, offset, new_block, new_offset in records))
+        self.count += len(records)
+
+    def chunks(self, size):
+        if self._file is None:
+            return
+        self._file.seek(0)
+        unpack = self.record.unpack_from
+        record_size = self.record.size
+        actions = self.actions
+        remaining = self.count
+        while remaining:
+            count = min(size, remaining)
+            data = self._file.read(count * record_size)
+            chunk = []
+            for position in range(0, count * record_size, record_size):
+                code, rel_node, block, offset, new_block, new_offset = unpack(data, position)
+                chunk.append((actions[code], rel_node, block, offset, new_block, new_offset))
+            remaining -= count
+            yield chunk
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.count = 0
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import signal
+import logging
+import cProfile
+import threading
+import BaseHTTPServer
+from contextlib import contextmanager
+
+
+def seconds_since(timestamp):
+    """
+    Seconds from a master timestamp like 2014-03-01 10:00:00.123 until now,
+    the master is assumed to log in the local time zone
+    """
+    seconds, _, fraction = str(timestamp).partition('.')
+    then = time.mktime(time.strptime(seconds, '%Y-%m-%d %H:%M:%S'))
+    if fraction:
+        then += float('0.' + fraction)
+    return time.time() - then
+
+
+class Histogram(object):
+    # Upper bounds in seconds, the last bucket takes everything else
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+class Stats(object):
+    """
+    Counters, gauges and latency histograms shared by the replayer threads.
+    Names are reported with a marty_ prefix, histograms in seconds.
+    """
+    prefix = 'marty_'
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def render(self):
+        """
+        The stats in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.iteritems()):
+                lines.append('{}{}_total {}'.format(self.prefix, name, value))
+            for name, value in sorted(self.gauges.iteritems()):
+                lines.append('{}{} {}'.format(self.prefix, name, value))
+            for name, histogram in sorted(self.histograms.iteritems()):
+                name = '{}{}_seconds'.format(self.prefix, name)
+                total = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    total += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, total))
+                lines.append('{}_sum {}'.format(name, histogram.sum))
+                lines.append('{}_count {}'.format(name, histogram.count))
+                lines.append('{}_max {}'.format(name, histogram.max))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsReporter(object):
+    """
+    Writes the stats to a file every interval seconds and/or serves them over
+    HTTP on localhost, both from daemon threads
+    """
+
+    def __init__(self, stats, path=None, port=None, interval=10, logger=None):
+        self.stats = stats
+        self.path = path
+        self.interval = interval
+        self.server = None
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger()
+            self.logger.addHandler(logging.NullHandler())
+
+        if path:
+            thread = threading.Thread(target=self._write_loop)
+            thread.daemon = True
+            thread.start()
+        if port:
+            self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), self._handler())
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.logger.info('serving stats on port {}'.format(port))
+
+    def _handler(self):
+        stats = self.stats
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = stats.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def write(self):
+        # Rename so readers never see a half written file
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            f.write(self.stats.render())
+        os.rename(tmp, self.path)
+
+    def _write_loop(self):
+        while True:
+            try:
+                self.write()
+            except (IOError, OSError):
+                self.logger.exception('writing stats to {} failed'.format(self.path))
+            time.sleep(self.interval)
+
+    def close(self):
+        if self.path:
+            self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class Profiler(object):
+    """
+    Profiles the main thread between two signals and dumps the profile to
+    path, loadable with pstats
+    """
+
+    def __init__(self, path, signum=signal.SIGUSR1, logger=None):
+        self.path = path
+        self.profile = None
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger()
+            self.logger.addHandler(logging.NullHandler())
+        signal.signal(signum, self.toggle)
+
+    def toggle(self, signum=None, frame=None):
+        if self.profile is None:
+            self.logger.info('profiling started')
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            self.profile = None
+            self.logger.info('profile written to {}'.format(self.path))
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import Queue
+from collections import OrderedDict
+
+from stats import Stats, seconds_since
+from populator import HistoryPopulator
+
+
+class HistoryWriter(object):
+    """
+    Applies replayed commits to the history database on a background thread,
+    so history writes for one commit overlap with replaying and reading the
+    next ones from the slave.
+
+    A commit is a master timestamp, the WAL position of the commit record and
+    a list of changes. Each change is a (function, args) pair called as
+    function(populator, *args). Commits are applied in the order they are
+    submitted, each in its own history transaction. At most `depth` commits wait in the queue, with a depth of
+    0 commits are applied right away on the calling thread.
+    """
+
+    def __init__(self, populator, depth=4, logger=None, stats=None):
+        self.populator = populator
+        self.depth = depth
+        self.stats = stats or Stats()
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger()
+            self.logger.addHandler(logging.NullHandler())
+        self._error = None
+        self._queue = None
+        self._thread = None
+        if depth > 0:
+            self._queue = Queue.Queue(depth)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, timestamp, lsn, changes):
+        self.check()
+        if self._queue:
+            self._queue.put((timestamp, lsn, changes))
+        else:
+            self.apply(timestamp, lsn, changes)
+
+    def apply(self, timestamp, lsn, changes):
+        populator = self.populator
+        with self.stats.timer('write'):
+            populator.begin()
+            populator.update(timestamp, lsn)
+            for function, args in changes:
+                function(populator, *args)
+            populator.commit()
+        self.lag(timestamp)
+
+    def apply_chunks(self, timestamp, lsn, chunks):
+        """
+        Applies a commit with too many changes to hold at once, on the
+        calling thread after the commits before it. chunks yields lists of
+        changes, each is written out before the next one is made.
+        """
+        self.wait()
+        populator = self.populator
+        with self.stats.timer('write'):
+            populator.begin()
+            populator.update(timestamp, lsn)
+            for changes in chunks:
+                for function, args in changes:
+                    function(populator, *args)
+                populator.flush()
+            populator.commit()
+        self.lag(timestamp)
+
+    def lag(self, timestamp):
+        if timestamp:
+            lag = seconds_since(timestamp)
+            self.stats.gauge('last_lag_seconds', lag)
+            self.stats.observe('lag', lag)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if not self._error:
+                    self.apply(*item)
+            except Exception as e:
+                self.logger.exception('applying commit failed')
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def check(self):
+        """
+        Raises the error of a failed commit in the calling thread
+        """
+        if self._error:
+            raise self._error
+
+    @property
+    def backlog(self):
+        if self._queue:
+            return self._queue.qsize()
+        return 0
+
+    def wait(self):
+        """
+        Blocks until every submitted commit has been applied
+        """
+        if self._queue:
+            self._queue.join()
+        self.check()
+
+    def close(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.check()
+
+
+class ShardedWriter(HistoryWriter):
+    """
+    HistoryWriter that spreads the data changes of each commit over shard
+    populators, each with its own connection and thread. The changes to a
+    data table always go to the same shard, so they are applied in order,
+    while different tables are written side by side.
+
+    The marty_updates row of a commit is written first, not complete. It
+    is completed once every shard has committed its part and every earlier
+    update is complete. Commits that change the catalog wait for the shards
+    and are applied whole on the main populator.
+    """
+
+    # Populator methods whose first argument is the only table they write to
+    data_changes = ('insert', 'insert_delta', 'delete', 'insert_version', 'delete_key', 'delete_all',
+                    'bulk_diff')
+
+    def __init__(self, populator, shards, depth=4, logger=None, stats=None):
+        self.shards = shards
+        # Plain functions, Python 2 wraps them in unbound methods
+        self._data_functions = set(HistoryPopulator.__dict__[name] for name in self.data_changes)
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._queues = []
+        self._threads = []
+        HistoryWriter.__init__(self, populator, depth, logger=logger, stats=stats)
+        for shard in shards:
+            queue = Queue.Queue(max(depth, 1))
+            thread = threading.Thread(target=self._run_shard, args=(shard, queue))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(queue)
+            self._threads.append(thread)
+
+    def split(self, changes):
+        """
+        The changes of each shard by shard number, None if some change is not
+        to a single data table
+        """
+        parts = {}
+        for function, args in changes:
+            if getattr(function, '__func__', function) not in self._data_functions:
+                return None
+            shard = hash(args[0].internal_name) % len(self.shards)
+            parts.setdefault(shard, []).append((function, args))
+        return parts
+
+    def apply(self, timestamp, lsn, changes):
+        parts = self.split(changes)
+        if parts is None:
+            self.drain()
+            HistoryWriter.apply(self, timestamp, lsn, changes)
+            # The shards' statements may be for columns that changed
+            for shard in self.shards:
+                shard.reset_statements()
+            return
+
+        with self.stats.timer('dispatch'):
+            self.populator.update(timestamp, lsn, complete=False)
+            update_id = self.populator.update_id
+            with self._lock:
+                self._pending[update_id] = [len(parts), timestamp]
+                self._complete()
+            for shard, shard_changes in parts.iteritems():
+                self._queues[shard].put((update_id, shard_changes))
+
+    def apply_chunks(self, timestamp, lsn, chunks):
+        HistoryWriter.apply_chunks(self, timestamp, lsn, chunks)
+        for shard in self.shards:
+            shard.reset_statements()
+
+    def _run_shard(self, populator, queue):
+        while True:
+            item = queue.get()
+            try:
+                if item is None:
+                    return
+                if not self._error:
+                    update_id, changes = item
+                    with self.stats.timer('write'):
+                        populator.begin()
+                        populator.update_id = update_id
+                        for function, args in changes:
+                            function(populator, *args)
+                        populator.commit()
+                    with self._lock:
+                        self._pending[update_id][0] -= 1
+                        self._complete()
+            except Exception as e:
+                self.logger.exception('applying commit failed')
+                self._error = e
+            finally:
+                queue.task_done()
+
+    def _complete(self):
+        # Called with the lock held, completes updates strictly in order
+        completed = []
+        while self._pending:
+            update_id, (remaining, timestamp) = next(self._pending.iteritems())
+            if remaining:
+                break
+            del self._pending[update_id]
+            completed.append(update_id)
+            self.lag(timestamp)
+        if completed:
+            self.populator.complete_updates(completed)
+
+    def drain(self):
+        """
+        Blocks until the shards have applied every commit handed to them
+        """
+        for queue in self._queues:
+            queue.join()
+        self.check()
+
+    @property
+    def backlog(self):
+        return HistoryWriter.backlog.fget(self) + max(queue.qsize() for queue in self._queues)
+
+    def wait(self):
+        HistoryWriter.wait(self)
+        self.drain()
+
+    def close(self):
+        try:
+            HistoryWriter.close(self)
+            self.drain()
+        finally:
+            for queue in self._queues:
+                queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []